@@ -0,0 +1,203 @@
+import pandas as pd
+import numpy as np
+
+from instrument import timed
+
+# =====================================================================
+# Partial aggregates per export file
+# =====================================================================
+# Every normalised export gets a handful of small partial aggregates
+# (sums and counts per month/SKU/country/day, first/last values, ...).
+# The dashboard tables are then built by merging the partials of all files
+# instead of grouping the full history again, so when a new monthly export
+# arrives only that file has to be grouped. Partials are always merged in
+# file order, which keeps "first"/"last" identical to grouping the
+# concatenated frames.
+AMOUNT = "Amount (Merchant Currency)"
+
+
+def _aggregate(grouped, spec, names):
+    # grouped.agg(spec) with the result columns renamed to names; on the
+    # small per-file frames this is several times faster than pandas' named
+    # aggregation (agg(name=(column, func), ...))
+    result = grouped.agg(spec)
+    result.columns = names
+    return result
+
+
+@timed("aggregate.sales_partials")
+def sales_partials(df):
+    # Older export formats lack some columns (e.g. "Buyer Country"); those
+    # rows simply do not count for that grouping, as after concatenation.
+    # Amounts are stored as float32 but summed as float64.
+    df = df.reindex(columns=["Month", "Sku Id", "Buyer Country", "Transaction Date", AMOUNT])
+    df[AMOUNT] = df[AMOUNT].astype("float64")
+    sum_count = {AMOUNT: "sum", "Transaction Date": "count"}
+    return {
+        "by_month": _aggregate(df.groupby("Month"), sum_count, ["amount", "count"]),
+        "by_sku_month": _aggregate(df.groupby(["Sku Id", "Month"], observed=True), sum_count, ["amount", "count"]),
+        "by_country": _aggregate(df.groupby("Buyer Country", observed=True), {AMOUNT: ["sum", "size"]},
+                                 ["amount", "transactions"]),
+    }
+
+
+@timed("aggregate.cube_partials")
+def cube_partials(df):
+    # Amount and count per (day, SKU, country) for the sales cube; only the
+    # dashboard's month drill-down needs it (see merge_cube)
+    df = df.reindex(columns=["Sku Id", "Buyer Country", "Transaction Date", AMOUNT])
+    df[AMOUNT] = df[AMOUNT].astype("float64")
+    dated = df[df["Transaction Date"].notna()]
+    grouped = dated.groupby([dated["Transaction Date"].dt.normalize().rename("Day"), "Sku Id", "Buyer Country"],
+                            observed=True, dropna=False)
+    return _aggregate(grouped, {AMOUNT: "sum", "Transaction Date": "count"}, ["amount", "count"])
+
+
+@timed("aggregate.crash_partials")
+def crash_partials(df):
+    df = df.reindex(columns=["Date", "Daily Crashes"])
+    return {
+        "daily": df.groupby("Date").agg({"Daily Crashes": "first"}),
+    }
+
+
+@timed("aggregate.ratings_partials")
+def ratings_partials(df):
+    rows = df
+    df = df.reindex(columns=["Date", "Country", "Daily Average Rating", "Total Average Rating"])
+    # the whole row of each country's most recent day, for the reports (see
+    # merge_latest_ratings)
+    latest_idx = df.groupby("Country")["Date"].idxmax()
+    return {
+        "daily": _aggregate(df.groupby("Date"), {"Daily Average Rating": ["sum", "count"]},
+                            ["rating_sum", "rating_count"]),
+        "last_rating": df.groupby("Country").agg({"Total Average Rating": "last"}),
+        "latest": rows.loc[latest_idx],
+    }
+
+
+def _merge(partials, name):
+    frames = [p[name] for p in partials]
+    return pd.concat(frames) if frames else None
+
+
+def _reset(df, names):
+    # Index back to columns, as plain strings rather than categories
+    df = df.reset_index()
+    return df.astype({name: str for name in names})
+
+
+@timed("aggregate.merge_sales")
+def merge_sales(partials):
+    by_month = _merge(partials, "by_month")
+    if by_month is None:
+        return {"sales_by_month": pd.DataFrame({"Month": [], AMOUNT: [], "Transaction Count": []}),
+                "sku_sales_df": pd.DataFrame({"Sku Id": [], "Month": [], AMOUNT: [], "Transaction Count": []}),
+                "country_sales": pd.DataFrame({"Buyer Country": [], AMOUNT: []}),
+                "transactions_per_country": pd.DataFrame({"Country": [], "Transactions": []})}
+    columns = {"amount": AMOUNT, "count": "Transaction Count"}
+    sales_by_month = _reset(by_month.groupby(level="Month").sum().rename(columns=columns), ["Month"])
+    sku_sales_df = _reset(_merge(partials, "by_sku_month").groupby(level=["Sku Id", "Month"]).sum()
+                          .rename(columns=columns), ["Sku Id", "Month"])
+    by_country = _merge(partials, "by_country").groupby(level="Buyer Country").sum()
+    country_sales = _reset(by_country[["amount"]].rename(columns={"amount": AMOUNT}), ["Buyer Country"])
+    transactions_per_country = _reset(by_country["transactions"].rename("Transactions"), ["Buyer Country"]) \
+        .rename(columns={"Buyer Country": "Country"})
+    return {"sales_by_month": sales_by_month, "sku_sales_df": sku_sales_df,
+            "country_sales": country_sales, "transactions_per_country": transactions_per_country}
+
+
+@timed("aggregate.merge_cube")
+def merge_cube(cubes):
+    # Sales cube: amount and transaction count per (month, day, SKU, country),
+    # plus the per-month rollups behind the month drill-down of p1 and p2,
+    # so a month selection is a dictionary lookup instead of a scan over
+    # all transactions.
+    if not cubes:
+        return {"sales_cube": pd.DataFrame({"Month": [], "Day": [], "Sku Id": [], "Buyer Country": [],
+                                            "amount": [], "count": []}),
+                "sales_by_day": {}, "sku_sales_by_month": {}}
+    cube = pd.concat(cubes)
+    cube = cube.groupby(level=["Day", "Sku Id", "Buyer Country"], observed=True, dropna=False).sum().reset_index()
+    cube.insert(0, "Month", cube["Day"].dt.to_period("M").astype(str))
+    cube["Day"] = cube["Day"].dt.strftime("%Y-%m-%d")
+
+    columns = {"amount": AMOUNT, "count": "Transaction Count"}
+    sales_by_day = {}
+    for month, days in cube.groupby("Month")[["Day", "amount", "count"]]:
+        # p1 plots the days on its "Month" axis
+        days = days.groupby("Day").sum().rename(columns=columns)
+        sales_by_day[month] = _reset(days, ["Day"]).rename(columns={"Day": "Month"})
+    sku_sales_by_month = {}
+    for month, skus in cube.groupby("Month")[["Sku Id", "amount", "count"]]:
+        skus = skus.groupby("Sku Id", observed=True).sum().rename(columns=columns)
+        sku_sales_by_month[month] = _reset(skus, ["Sku Id"])
+    return {"sales_cube": cube, "sales_by_day": sales_by_day, "sku_sales_by_month": sku_sales_by_month}
+
+
+@timed("aggregate.merge_ratings_crashes")
+def merge_ratings_crashes(crash_parts, rating_parts):
+    # Daily crashes (first value per day) next to the mean daily rating over
+    # all countries, for the days that have crash data.
+    crashes = _merge(crash_parts, "daily")
+    if crashes is None:
+        return pd.DataFrame({"Date": pd.Series([], dtype="datetime64[ns]"),
+                             "Daily Crashes": [], "Daily Average Rating": []})
+    daily = crashes.groupby(level="Date").first()
+    ratings = _merge(rating_parts, "daily")
+    if ratings is not None:
+        ratings = ratings.groupby(level="Date").sum()
+        daily["Daily Average Rating"] = (ratings["rating_sum"] / ratings["rating_count"].replace(0, np.nan)) \
+            .reindex(daily.index)
+    else:
+        daily["Daily Average Rating"] = np.nan
+    return daily.reset_index()
+
+
+@timed("aggregate.merge_latest_ratings")
+def merge_latest_ratings(rating_parts):
+    # The ratings row of each country's most recent day (the first one in
+    # file order), sorted by country: what idxmax over all rows would pick
+    latest = _merge(rating_parts, "latest")
+    if latest is None:
+        return pd.DataFrame({"Date": [], "Product id": [], "Country": [], "Daily Average Rating": [],
+                             "Total Average Rating": []})
+    latest = latest.reset_index(drop=True)
+    latest_idx = latest.groupby("Country")["Date"].idxmax()
+    return latest.loc[latest_idx].reset_index(drop=True)
+
+
+@timed("aggregate.merge_country_ratings")
+def merge_country_ratings(rating_parts):
+    # "last" rating per country (p5) and the rating of each country's most
+    # recent day (world map)
+    last_rating = _merge(rating_parts, "last_rating")
+    if last_rating is None:
+        empty = pd.DataFrame({"Country": [], "Total Average Rating": []})
+        return empty, empty
+    ratings_per_country = last_rating.groupby(level="Country").last().reset_index()
+    country_ratings_latest = merge_latest_ratings(rating_parts)[["Country", "Total Average Rating"]]
+    return ratings_per_country, country_ratings_latest
+
+
+@timed("aggregate.update_rolling")
+def update_rolling(current, previous, column, window, previous_mean=None):
+    # Rolling mean of current[column] that reuses previous_mean (the same
+    # rolling mean of previous[column]) for the leading days that did not
+    # change, so appending a month only recomputes the new days plus
+    # window - 1 days of context.
+    values = current[column].reset_index(drop=True)
+    start = 0
+    if previous is not None and previous_mean is not None:
+        n = min(len(current), len(previous))
+        same_date = current["Date"].to_numpy()[:n] == previous["Date"].to_numpy()[:n]
+        old = previous[column].to_numpy(dtype=float)[:n]
+        new = values.to_numpy(dtype=float)[:n]
+        same_value = (old == new) | (np.isnan(old) & np.isnan(new))
+        unchanged = same_date & same_value
+        start = n if unchanged.all() else int(np.argmin(unchanged))
+    context = max(start - window + 1, 0)
+    tail = values.iloc[context:].rolling(window=window, min_periods=1).mean().iloc[start - context:]
+    if start == 0:
+        return tail.to_numpy()
+    return np.concatenate([np.asarray(previous_mean)[:start], tail.to_numpy()])
@@ -0,0 +1,202 @@
+import os
+import threading
+
+from currency import as_of_rates
+from ingest_cache import ROW
+from instrument import timed
+
+# =====================================================================
+# Out-of-core aggregation over the ingest cache (optional, DuckDB)
+# =====================================================================
+# With DATA_BACKEND=duckdb (see data_store) the normalised exports are not
+# loaded into pandas at all. The per-file partial aggregates (see
+# aggregates.py) are computed by DuckDB straight from the export's Feather
+# partitions in the ingest cache, read as an Arrow dataset in batches, so
+# memory depends on the size of the aggregates and not on the number of
+# transactions. Everything after the partials (merging, moving averages,
+# the time index, ...) is shared with the pandas path and returns the same
+# tables.
+#
+# The SQL below mirrors ingest.finish_sales/finish_crashes/finish_ratings
+# and aggregates.*_partials; a change to one needs the same change here.
+#
+#   DUCKDB_MEMORY_LIMIT=2GB   cap DuckDB's memory (default: DuckDB's own)
+#   DUCKDB_THREADS=4          threads per query (default: all cores)
+#
+# DuckDB is only imported when this backend is used (pip install duckdb).
+AMOUNT = "Amount (Merchant Currency)"
+RATE = "Currency Conversion Rate"
+memory_limit = os.environ.get("DUCKDB_MEMORY_LIMIT")
+threads = int(os.environ.get("DUCKDB_THREADS", "0"))
+
+_lock = threading.Lock()
+_connection = None
+# One cursor per thread: opening one costs about as much as a small query
+_local = threading.local()
+
+
+def cursor():
+    # A cursor on the process' in-memory database for the calling thread
+    global _connection
+    if getattr(_local, "cursor", None) is None:
+        with _lock:
+            if _connection is None:
+                import duckdb
+                config = {}
+                if memory_limit:
+                    config["memory_limit"] = memory_limit
+                if threads:
+                    config["threads"] = threads
+                _connection = duckdb.connect(config=config)
+            _local.cursor = _connection.cursor()
+    return _local.cursor
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _column(entry, name, type="VARCHAR"):
+    # A column of the export, or NULL when its format lacks it (as the
+    # reindex in aggregates.py does)
+    return _quote(name) if name in entry["columns"] else f"CAST(NULL AS {type})"
+
+
+def _dataset(paths):
+    # The Feather partitions as one Arrow dataset; partitions of an export
+    # can disagree on the type of an all-empty column, hence the unified
+    # schema
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    schemas = [ds.dataset(path, format="feather").schema for path in paths]
+    schema = pa.unify_schemas(schemas, promote_options="permissive")
+    return ds.dataset(paths, schema=schema, format="feather")
+
+
+@timed("archive.entry")
+def entry(kind, paths):
+    # The entry of one export and product for product_entries: where its
+    # rows are, not the rows themselves
+    dataset = _dataset(paths)
+    columns = [name for name in dataset.schema.names if name != ROW]
+    return {"kind": kind, "paths": paths, "columns": columns, "has_rates": RATE in columns,
+            "rows": dataset.count_rows()}
+
+
+def query(entry, sql, **tables):
+    # Run sql with the export's rows as `src` (and every frame in tables
+    # under its name)
+    current = cursor()
+    current.register("src", _dataset(entry["paths"]))
+    for name, df in tables.items():
+        current.register(name, df)
+    return current.execute(sql).df()
+
+
+def _day_rates(entry, rate_table):
+    # The as-of rate (see currency.as_of_rates) of every currency and day
+    # in a sales export without rates; joining these is much faster than
+    # an ASOF JOIN on an Arrow scan
+    days = query(entry, f"""
+        SELECT DISTINCT {_column(entry, "Buyer Currency")} AS currency, CAST("Transaction Date" AS DATE) AS day
+        FROM src WHERE "Transaction Date" IS NOT NULL""")
+    days["day"] = days["day"].astype("datetime64[us]")
+    days["rate"] = as_of_rates(days["currency"], days["day"], rate_table)
+    return days
+
+
+@timed("archive.sales_groups")
+def sales_groups(entry, rate_table):
+    # Amount, count and rows per month, day, SKU and country of a sales
+    # export, with the amounts as finish_sales() makes them: without
+    # merchant amounts, the charged amount times the export's own rate or
+    # else the as-of rate of its currency and day
+    date = _quote("Transaction Date")
+    tables = {}
+    joins = ""
+    if AMOUNT in entry["columns"]:
+        amount = f"CAST({_quote(AMOUNT)} AS DOUBLE)"
+    else:
+        if entry["has_rates"]:
+            rate = f"TRY_CAST({_quote(RATE)} AS DOUBLE)"
+        else:
+            tables["day_rates"] = _day_rates(entry, rate_table)
+            rate = "r.rate"
+            joins = f"""
+            LEFT JOIN day_rates r ON {_column(entry, "Buyer Currency")} = r.currency
+                AND CAST({date} AS DATE) = r.day"""
+        amount = f"CAST(CAST(CAST({_quote('Charged Amount')} AS DOUBLE) * {rate} AS FLOAT) AS DOUBLE)"
+    return query(entry, f"""
+        SELECT COALESCE(strftime({date}, '%Y-%m'), 'NaT') AS "Month", date_trunc('day', {date}) AS "Day",
+               {_column(entry, "Sku Id")} AS "Sku Id", {_column(entry, "Buyer Country")} AS "Buyer Country",
+               COALESCE(fsum({amount}), 0) AS amount, count({date}) AS count, count(*) AS transactions
+        FROM src{joins}
+        GROUP BY ALL""", **tables)
+
+
+def _sum(groups, keys, columns):
+    return groups.groupby(keys, sort=True)[columns].sum()
+
+
+@timed("archive.sales_partials")
+def sales_partials(entry, rate_table):
+    # aggregates.sales_partials() and cube_partials() of a sales export,
+    # from one scan
+    groups = sales_groups(entry, rate_table)
+    groups["Day"] = groups["Day"].astype("datetime64[us]")
+    dated = groups[groups["Day"].notna()]
+    return {
+        "by_month": _sum(groups, "Month", ["amount", "count"]),
+        "by_sku_month": _sum(groups, ["Sku Id", "Month"], ["amount", "count"]),
+        "by_country": _sum(groups, "Buyer Country", ["amount", "transactions"]),
+        "cube": dated.set_index(["Day", "Sku Id", "Buyer Country"])[["amount", "count"]].sort_index(),
+    }
+
+
+@timed("archive.crash_partials")
+def crash_partials(entry):
+    # aggregates.crash_partials() after finish_crashes(): the first crash
+    # count (missing counts as 0) per day, in file order
+    daily = query(entry, f"""
+        SELECT "Date", first(COALESCE({_column(entry, 'Daily Crashes', 'DOUBLE')}, 0) ORDER BY _row)
+               AS "Daily Crashes"
+        FROM src WHERE "Date" IS NOT NULL GROUP BY "Date" ORDER BY "Date" """)
+    return {"daily": daily.set_index("Date")}
+
+
+@timed("archive.ratings_partials")
+def ratings_partials(entry):
+    # aggregates.ratings_partials() after finish_ratings()
+    daily_rating = _column(entry, "Daily Average Rating", "DOUBLE")
+    total_rating = _column(entry, "Total Average Rating", "DOUBLE")
+    daily = query(entry, f"""
+        SELECT "Date", COALESCE(fsum({daily_rating}), 0) AS rating_sum, count({daily_rating}) AS rating_count
+        FROM src WHERE "Date" IS NOT NULL GROUP BY "Date" ORDER BY "Date" """)
+    last_rating = query(entry, f"""
+        SELECT "Country", arg_max({total_rating}, _row) FILTER (WHERE {total_rating} IS NOT NULL)
+               AS "Total Average Rating"
+        FROM src WHERE "Country" IS NOT NULL GROUP BY "Country" ORDER BY "Country" """)
+    # the whole row of each country's most recent day (the first of them in
+    # file order), as idxmax picks it
+    columns = ", ".join(_quote(name) for name in entry["columns"])
+    if "Daily Average Rating" not in entry["columns"]:
+        columns += ', CAST(NULL AS DOUBLE) AS "Daily Average Rating"'
+    latest = query(entry, f"""
+        SELECT {columns} FROM src WHERE "Date" IS NOT NULL AND "Country" IS NOT NULL
+        QUALIFY row_number() OVER (PARTITION BY "Country" ORDER BY "Date" DESC, _row) = 1
+        ORDER BY "Country" """)
+    return {
+        "daily": daily.set_index("Date"),
+        "last_rating": last_rating.set_index("Country"),
+        "latest": latest,
+    }
+
+
+def partials(entry, rate_table):
+    # The partials of an entry, as product_entries keeps them (for sales
+    # including the cube)
+    if entry["kind"] == "sales":
+        return sales_partials(entry, rate_table)
+    if entry["kind"] == "crashes":
+        return crash_partials(entry)
+    return ratings_partials(entry)
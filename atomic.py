@@ -0,0 +1,27 @@
+import os
+import threading
+
+# =====================================================================
+# Atomic file writes
+# =====================================================================
+# Every file that another process (a second server, a report reader, the
+# browser) may read while it is written goes through write_atomic(): the
+# data is written to a temporary file next to it, which then replaces the
+# file in one os.replace(), so readers see either the old or the new file
+# and never a half written one. A failed write leaves no temporary file.
+
+
+def write_atomic(path, write, suffix=""):
+    # Call write(tmp_path) and move the result to path. suffix is appended
+    # to the temporary name for writers that insist on an extension
+    # (np.savez adds ".npz" otherwise).
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp{suffix}"
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
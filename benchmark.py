@@ -0,0 +1,474 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import bokeh
+import numpy as np
+import pandas as pd
+
+import data_store
+import queries
+from atomic import write_atomic
+from aggregates import (sales_partials, cube_partials, crash_partials, ratings_partials, merge_sales, merge_cube,
+                        merge_ratings_crashes, merge_country_ratings, update_rolling)
+from geo import load_shapes
+from ingest import detect_encoding
+from ingest_cache import IngestCache
+from instrument import rss, max_rss
+from payload_cache import payload_cache
+from dashboard import Dashboard
+from export import export_dashboard
+from synthetic import generate
+
+# =====================================================================
+# Benchmarks
+# =====================================================================
+# Times every stage from CSV to HTML on a synthetic data/ directory (see
+# synthetic.py) and writes the results as JSON, so runs before and after
+# a change can be compared:
+#
+#   python benchmark.py -n 1000000 -o before.json
+#   python benchmark.py -n 1000000 -o after.json
+#   python benchmark.py --compare before.json after.json
+#   python benchmark.py -n 1000000 --verify   same data either way?
+#
+# Stages: encoding detection, a cold ingest (parse into an empty cache,
+# then load one product), the shapes, every aggregate on its own and all of
+# them together (DashboardData), a warm start from the cache, building a
+# Dashboard, every callback over all its options (cold and warm payload
+# cache) and the HTML export. Per stage the wall time, the peak RSS during
+# the stage and the RSS change are recorded, for the callbacks also their
+# payload cache hits and misses.
+#
+# --root keeps the generated exports (and reuses them when <root>/data
+# exists); without it they go to a temporary directory. Callbacks run
+# inline, as in the static export, so their times exclude the pool.
+# --backend duckdb times the out-of-core backend (see archive.py); its
+# partials are part of ingest.load, so the pandas aggregates are skipped.
+# --verify times nothing: it loads the exports with both backends, and
+# ingests them serially and with --workers (at least 2) processes, and
+# fails when the cached rows, tables or reports differ.
+RSS_INTERVAL = 0.01
+# Stages more than this much slower are flagged by --compare
+REGRESSION_THRESHOLD = 0.1
+# The DashboardData tables that must not depend on the backend or the
+# number of ingest workers (--verify)
+VERIFY_TABLES = ["sales_by_month", "sku_sales_df", "sales_cube", "sales_by_day", "sku_sales_by_month",
+                 "ratings_crashes", "country_sales", "ratings_per_country", "latest_ratings", "world_map",
+                 "transactions_per_country", "country_data"]
+# Relative tolerance for amounts: DuckDB and pandas sum in another order
+VERIFY_RTOL = 1e-9
+
+
+class PeakRss:
+    # Samples the RSS in a thread while the with-block runs
+    def __enter__(self):
+        self.start = self.peak = rss()
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def _sample(self):
+        while not self._done.wait(RSS_INTERVAL):
+            self.peak = max(self.peak, rss())
+
+    def __exit__(self, *exc):
+        self._done.set()
+        self._thread.join()
+        self.end = rss()
+        self.peak = max(self.peak, self.end)
+
+
+class Benchmark:
+    def __init__(self):
+        self.stages = []
+
+    def measure(self, name, func, **extra):
+        # Run func() once as stage `name` and return its result
+        with PeakRss() as rss:
+            start = time.perf_counter()
+            result = func()
+            seconds = time.perf_counter() - start
+        self._record(name, seconds, rss, extra)
+        return result
+
+    def measure_calls(self, name, calls, **extra):
+        # Run every call in calls as one stage; also records the slowest
+        durations = []
+        with PeakRss() as rss:
+            for call in calls:
+                start = time.perf_counter()
+                call()
+                durations.append(time.perf_counter() - start)
+        self._record(name, sum(durations), rss, dict(extra, calls=len(durations),
+                                                     max_seconds=round(max(durations, default=0), 6)))
+
+    def _record(self, name, seconds, rss, extra):
+        stage = {"name": name, "seconds": round(seconds, 6),
+                 "peak_rss_mb": round(rss.peak / 2**20, 1), "rss_delta_mb": round((rss.end - rss.start) / 2**20, 1)}
+        stage.update(extra)
+        self.stages.append(stage)
+        print(f"{name:45} {seconds:10.3f} s {stage['peak_rss_mb']:10.1f} MB", file=sys.stderr)
+
+
+def _select(widget, update, value):
+    # Pick value in a widget; on_change does not fire for the current value
+    if widget.value == value:
+        update(None, None, None)
+    else:
+        widget.value = value
+
+
+def callback_calls(dashboard):
+    # {callback: [calls]} covering every option of every widget
+    calls = {}
+    calls["update_overview"] = [
+        lambda v=v: _select(dashboard.select_overview, dashboard.update_overview, v)
+        for v in dashboard.select_overview.options[1:] + ["All Months"]]
+    calls["update_sku_plot"] = [
+        lambda v=v: _select(dashboard.select_sku, dashboard.update_sku_plot, v)
+        for v in dashboard.select_sku.options]
+    calls["update_world_map"] = [
+        lambda v=v: _select(dashboard.select_map, dashboard.update_world_map, v)
+        for v in dashboard.select_map.options]
+    calls["update_p5"] = [
+        lambda v=v: _select(dashboard.select_country_p5, dashboard.update_p5, v)
+        for v in dashboard.select_country_p5.options]
+    calls["update_moving_averages"] = [
+        lambda v=v: _select(dashboard.rating_window, dashboard.update_moving_averages, v)
+        for v in [7, 14, 30, 60, 90, data_store.RATING_WINDOW]]
+    # zoom in on the newest dates in steps, then reset
+    dates = dashboard.p3_columns["Date"]
+    views = [(dates[0] + (dates[-1] - dates[0]) * (1 - 0.5 ** i), dates[-1]) for i in range(1, 8)]
+    calls["update_p3_range"] = [
+        lambda x0=x0, x1=x1: dashboard.update_p3_range(SimpleNamespace(x0=x0, x1=x1))
+        for x0, x1 in views + [(None, None)]]
+    # date ranges of growing length ending on the last day, then all days
+    index = dashboard.data.sales_index
+    if len(index):
+        windows = [(max(index.last - pd.Timedelta(days=days - 1), index.first), index.last)
+                   for days in [1, 7, 30, 90, 180, 365]] + [(index.first, index.last)]
+        calls["update_window"] = [
+            lambda window=window: _pick_range(dashboard, window) for window in windows]
+    return calls
+
+
+def _pick_range(dashboard, window):
+    # Drag the date range to window (value_throttled: as from the browser)
+    dashboard.date_range.value = window
+    dashboard.update_window(None, None, None)
+
+
+def aggregate_stages(bench, entries, rows, csv_files, product_id, cache_path):
+    # Every aggregate on its own, on the normalised frames
+    cache = IngestCache(cache_path)
+    rate_table = data_store.current_rate_table(csv_files)
+    frames = {kind: [data_store.normalised_frame(cache, e, product_id, rate_table) for e in entries
+                     if e["kind"] == kind] for kind in ["sales", "crashes", "ratings"]}
+    sales_parts = bench.measure("aggregate.sales_partials", lambda: [sales_partials(df) for df in frames["sales"]],
+                                rows=rows["sales"])
+    cubes = bench.measure("aggregate.cube_partials", lambda: [cube_partials(df) for df in frames["sales"]],
+                          rows=rows["sales"])
+    crash_parts = bench.measure("aggregate.crash_partials", lambda: [crash_partials(df) for df in frames["crashes"]],
+                                rows=rows["crashes"])
+    rating_parts = bench.measure("aggregate.ratings_partials",
+                                 lambda: [ratings_partials(df) for df in frames["ratings"]], rows=rows["ratings"])
+    bench.measure("aggregate.merge_sales", lambda: merge_sales(sales_parts))
+    bench.measure("aggregate.merge_cube", lambda: merge_cube(cubes))
+    ratings_crashes = bench.measure("aggregate.merge_ratings_crashes",
+                                    lambda: merge_ratings_crashes(crash_parts, rating_parts))
+    bench.measure("aggregate.merge_country_ratings", lambda: merge_country_ratings(rating_parts))
+    bench.measure("aggregate.moving_averages", lambda: [
+        update_rolling(ratings_crashes, None, "Daily Average Rating", data_store.RATING_WINDOW),
+        update_rolling(ratings_crashes, None, "Daily Crashes", data_store.CRASHES_WINDOW)],
+        rows=len(ratings_crashes))
+
+
+def run(bench, root, product_id=None, workers=1, backend="pandas"):
+    product_id = product_id or data_store.default_product_id
+    data_path = os.path.join(root, "data")
+    shapefile_path = os.path.join(root, "worldmap", "ne_110m_admin_0_countries.shp")
+    cache_path = os.path.join(root, "cache")
+    csv_files = data_store._csv_files(data_path)
+
+    bench.measure("detect_encoding", lambda: [detect_encoding(path) for path in csv_files], rows=len(csv_files))
+
+    # Cold start: empty cache
+    shutil.rmtree(cache_path, ignore_errors=True)
+    data_store.reset()
+    bench.measure("ingest.parse", lambda: data_store.sync_files(csv_files, cache_path, workers),
+                  bytes=sum(os.path.getsize(path) for path in csv_files))
+    entries = bench.measure("ingest.load", lambda: data_store.product_entries(csv_files, product_id, cache_path,
+                                                                              backend))
+    rows = {kind: sum(e["rows"] for e in entries if e["kind"] == kind) for kind in ["sales", "crashes", "ratings"]}
+    shapes = bench.measure("shapes", lambda: load_shapes(shapefile_path, cache_path))
+    data = bench.measure("dashboard_data", lambda: data_store.DashboardData(entries, shapes, product_id=product_id),
+                         rows=rows["sales"])
+    if backend == "pandas":
+        aggregate_stages(bench, entries, rows, csv_files, product_id, cache_path)
+
+    # Warm start: everything from the cache on disk
+    data_store.reset()
+    bench.measure("ingest.warm", lambda: data_store.get_data(data_path, shapefile_path, cache_path, workers,
+                                                              product_id, backend=backend))
+
+    dashboard = bench.measure("dashboard.build", lambda: Dashboard(data))
+    for state in ["cold", "warm"]:
+        if state == "cold":
+            payload_cache.clear()
+        for name, calls in callback_calls(dashboard).items():
+            before = payload_cache.stats()
+            bench.measure_calls(f"callback.{name}.{state}", calls)
+            after = payload_cache.stats()
+            # payload cache lookups of these calls
+            bench.stages[-1].update({key: after[key] - before[key] for key in ["hits", "misses", "evictions"]})
+
+    export_path = tempfile.mkdtemp(prefix="dashboard-export-")
+    try:
+        for name, sidecar in [("export.html", False), ("export.sidecar", True)]:
+            path = os.path.join(export_path, f"{name}.html")
+            sizes = bench.measure(name, lambda: export_dashboard(dashboard.layout, path, sidecar=sidecar))
+            bench.stages[-1]["bytes"] = sum(sizes.values())
+    finally:
+        shutil.rmtree(export_path, ignore_errors=True)
+    return rows
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def _column_drift(a, b):
+    # Where two columns differ, or None. Only values count: the backends
+    # give some columns other dtypes (categorical vs. string in sales_cube
+    # and latest_ratings, ...), so numbers are compared within VERIFY_RTOL,
+    # dates as dates and everything else as text.
+    if pd.api.types.is_numeric_dtype(a) and pd.api.types.is_numeric_dtype(b):
+        a, b = a.to_numpy(dtype=float), b.to_numpy(dtype=float)
+        same = np.isclose(a, b, rtol=VERIFY_RTOL, equal_nan=True)
+    elif pd.api.types.is_datetime64_any_dtype(a) and pd.api.types.is_datetime64_any_dtype(b):
+        a, b = a.astype("datetime64[ns]"), b.astype("datetime64[ns]")
+        same = ((a == b) | (a.isna() & b.isna())).to_numpy()
+    else:
+        a, b = a.astype(object), b.astype(object)
+        same = ((a.astype(str) == b.astype(str)) | (a.isna() & b.isna())).to_numpy()
+    if same.all():
+        return None
+    row = int(np.argmin(same))
+    first, second = (v.item() if isinstance(v, np.generic) else v for v in (a[row], b[row]))
+    return f"{(~same).sum()} rows, first row {row}: {first!r} vs {second!r}"
+
+
+def table_drift(a, b):
+    # Where two tables (or arrays) differ, or None; the index is ignored
+    if a is None or b is None:
+        return None if a is None and b is None else "missing in one backend"
+    if isinstance(a, np.ndarray):
+        a, b = pd.DataFrame({"values": a}), pd.DataFrame({"values": b})
+    if list(a.columns) != list(b.columns):
+        return f"columns {list(a.columns)} vs {list(b.columns)}"
+    if len(a) != len(b):
+        return f"{len(a)} vs {len(b)} rows"
+    a, b = a.reset_index(drop=True), b.reset_index(drop=True)
+    for column in a.columns:
+        drift = _column_drift(a[column], b[column])
+        if drift is not None:
+            return f"{column}: {drift}"
+    return None
+
+
+def data_drift(a, b):
+    # Where two DashboardData differ: every table in VERIFY_TABLES, moving
+    # average and report
+    tables = []
+    drifts = []
+    for name in VERIFY_TABLES:
+        first, second = getattr(a, name), getattr(b, name)
+        if isinstance(first, dict) and isinstance(second, dict):
+            # per month (sales_by_day, sku_sales_by_month)
+            if first.keys() != second.keys():
+                drifts.append(f"{name}: keys {sorted(first)} vs {sorted(second)}")
+                continue
+            tables += [(f"{name}[{key}]", first[key], second[key]) for key in first]
+        else:
+            tables.append((name, first, second))
+    tables += [(f"moving_average{key}", mean, b.moving_average(*key)) for key, mean in a.moving_averages.items()]
+    tables += [(f"queries.{name}", report(a), report(b)) for name, report in queries.REPORTS.items()]
+    for name, first, second in tables:
+        drift = table_drift(first, second)
+        if drift is not None:
+            drifts.append(f"{name}: {drift}")
+    for name in ["x_range_values", "unique_skus"]:
+        if getattr(a, name) != getattr(b, name):
+            drifts.append(f"{name}: {getattr(a, name)} vs {getattr(b, name)}")
+    return drifts
+
+
+def verify(root, product_id=None, workers=1):
+    # Load the exports in root with both backends and compare the data;
+    # returns the drifts
+    data_path = os.path.join(root, "data")
+    shapefile_path = os.path.join(root, "worldmap", "ne_110m_admin_0_countries.shp")
+    cache_path = os.path.join(root, "cache")
+    loaded = []
+    for backend in ["pandas", "duckdb"]:
+        data_store.reset()
+        loaded.append(data_store.get_data(data_path, shapefile_path, cache_path, workers, product_id,
+                                          backend=backend))
+    return data_drift(*loaded)
+
+
+def verify_workers(root, product_id=None, workers=2):
+    # Ingest the exports in root serially and with `workers` processes, each
+    # into an empty cache of its own, and compare what was cached (every
+    # partition row for row, and the daily rates) and the data loaded from
+    # it; returns the drifts
+    data_path = os.path.join(root, "data")
+    shapefile_path = os.path.join(root, "worldmap", "ne_110m_admin_0_countries.shp")
+    csv_files = data_store._csv_files(data_path)
+    caches, parsed, loaded = [], [], []
+    try:
+        for count in [1, workers]:
+            cache_path = os.path.join(root, f"cache-verify-{count}")
+            shutil.rmtree(cache_path, ignore_errors=True)
+            cache = IngestCache(cache_path)
+            caches.append(cache)
+            parsed.append(cache.load_many(csv_files, count))
+            cache.save_manifest()
+            data_store.reset()
+            loaded.append(data_store.get_data(data_path, shapefile_path, cache_path, count, product_id))
+
+        drifts = []
+        for path, serial, parallel in zip(csv_files, *parsed):
+            name = os.path.basename(path)
+            if serial != parallel:
+                drifts.append(f"{name}: {serial} vs {parallel}")
+                continue
+            kind, partitions = serial
+            for product in sorted({product for product, _ in partitions}):
+                first, second = (cache.read_product(path, product) for cache in caches)
+                if not first.equals(second):
+                    drifts.append(f"{name} ({product}): {table_drift(first, second) or 'dtypes differ'}")
+            first, second = (cache.read_rates(path) for cache in caches)
+            if (first is None) != (second is None) or (first is not None and not first.equals(second)):
+                drifts.append(f"{name}: daily rates differ")
+        return drifts + data_drift(*loaded)
+    finally:
+        for cache in caches:
+            shutil.rmtree(cache.cache_path, ignore_errors=True)
+
+
+def compare(base, new, threshold=REGRESSION_THRESHOLD):
+    # Print the stages of two result files side by side; returns the names
+    # of the stages that got more than threshold slower
+    base_stages = {stage["name"]: stage for stage in base["stages"]}
+    slower = []
+    print(f"{'stage':45} {'base s':>10} {'new s':>10} {'change':>8}")
+    for stage in new["stages"]:
+        old = base_stages.get(stage["name"])
+        if old is None:
+            print(f"{stage['name']:45} {'-':>10} {stage['seconds']:10.3f}")
+            continue
+        change = stage["seconds"] / old["seconds"] - 1 if old["seconds"] else 0.0
+        flag = ""
+        if change > threshold:
+            slower.append(stage["name"])
+            flag = "  slower"
+        print(f"{stage['name']:45} {old['seconds']:10.3f} {stage['seconds']:10.3f} {change:+8.1%}{flag}")
+    return slower
+
+
+def benchmark_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Time the dashboard pipeline on synthetic exports")
+    parser.add_argument("-n", "--transactions", type=int, default=100000,
+                        help="sales rows to generate (default: 100000)")
+    parser.add_argument("--months", type=int, default=12)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--root", help="generate into (or reuse) this directory instead of a temporary one")
+    parser.add_argument("-p", "--product", help="app to benchmark (default: DASHBOARD_PRODUCT_ID)")
+    parser.add_argument("-w", "--workers", type=int, default=data_store.ingest_workers,
+                        help="ingest processes (default: INGEST_WORKERS)")
+    parser.add_argument("-b", "--backend", choices=["pandas", "duckdb"], default=data_store.data_backend,
+                        help="where the aggregates are computed (default: DATA_BACKEND)")
+    parser.add_argument("-o", "--output", default="benchmark.json", help="JSON file to write the results to")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"),
+                        help="compare two result files instead of running")
+    parser.add_argument("--verify", action="store_true",
+                        help="check that the backends, and serial and parallel ingest, give the same data "
+                             "instead of timing")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = benchmark_arguments(argv)
+    if options.compare:
+        base, new = [json.load(open(path)) for path in options.compare]
+        return 1 if compare(base, new) else 0
+
+    root = options.root or tempfile.mkdtemp(prefix="dashboard-bench-")
+    try:
+        bench = Benchmark()
+        generated = not os.path.isdir(os.path.join(root, "data"))
+        if generated:
+            bench.measure("generate", lambda: generate(root, options.transactions, options.months,
+                                                       seed=options.seed))
+        if options.verify:
+            failed = False
+            for check, drifts in [("backends", verify(root, options.product, options.workers)),
+                                  ("serial and parallel ingest",
+                                   verify_workers(root, options.product, max(options.workers, 2)))]:
+                for drift in drifts:
+                    print(drift)
+                print(f"{check} differ" if drifts else f"{check} agree")
+                failed = failed or bool(drifts)
+            return 1 if failed else 0
+        rows = run(bench, root, options.product, options.workers, options.backend)
+    finally:
+        if options.root is None:
+            shutil.rmtree(root, ignore_errors=True)
+
+    results = {
+        "meta": {
+            "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "commit": _git_commit(),
+            # None when the exports in --root were reused
+            "transactions": options.transactions if generated else None,
+            "rows": rows,
+            "workers": options.workers,
+            "backend": options.backend,
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "numpy": np.__version__,
+            "bokeh": bokeh.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "max_rss_mb": round(max_rss() / 2**20, 1),
+            "payload_cache": payload_cache.stats(),
+        },
+        "stages": bench.stages,
+    }
+
+    def write(tmp_path):
+        with open(tmp_path, "w") as f:
+            json.dump(results, f, indent=1)
+    write_atomic(options.output, write)
+    print(options.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
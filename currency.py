@@ -0,0 +1,90 @@
+import pandas as pd
+import numpy as np
+
+from instrument import timed
+
+# =====================================================================
+# Currency conversion for the sales exports without rates
+# =====================================================================
+# Two old sales formats carry no Currency Conversion Rate. Their amounts
+# are converted with the rate of the same currency on the same day, taken
+# from the exports that do carry rates:
+#   - daily_rates() reduces one export (all apps) to the sum and count of
+#     its rates per currency and day. It runs once per export, at parse
+#     time, and is stored in the ingest cache next to its partitions.
+#   - merge_rates() merges those partials into the rate table: the mean
+#     rate per currency and day, sorted by currency and day.
+#   - as_of_rates() looks up, per row, the rate of its currency on its day
+#     or else the most recent day before it; rows before the first known
+#     day take the first known rate. One searchsorted over all rows.
+# A new export only adds its own partial, so the table is updated
+# incrementally.
+CURRENCY = "Buyer Currency"
+DATE = "Transaction Date"
+RATE = "Currency Conversion Rate"
+
+
+def _days(dates):
+    # Days since the epoch as int64 (NaT -> the int64 minimum)
+    return pd.DatetimeIndex(dates).to_numpy(dtype="datetime64[D]").astype(np.int64)
+
+
+@timed("currency.daily_rates")
+def daily_rates(df):
+    # Sum and count of the rates per currency and day of one sales export,
+    # None when it carries no rates
+    if RATE not in df.columns or DATE not in df.columns:
+        return None
+    rates = pd.DataFrame({
+        CURRENCY: df[CURRENCY].astype(object).to_numpy(),
+        "Date": pd.DatetimeIndex(df[DATE]).floor("D"),
+        RATE: pd.to_numeric(df[RATE], errors="coerce").to_numpy(dtype=float),
+    }).dropna()
+    grouped = rates.groupby([CURRENCY, "Date"], sort=True)[RATE].agg(["sum", "count"])
+    return grouped.reset_index()
+
+
+@timed("currency.merge_rates")
+def merge_rates(partials):
+    # Mean rate per currency and day over all partials, sorted by currency
+    # and day
+    partials = [p for p in partials if p is not None and len(p)]
+    if not partials:
+        return pd.DataFrame({CURRENCY: pd.Series(dtype=object), "Date": pd.Series(dtype="datetime64[ns]"),
+                             RATE: pd.Series(dtype=float)})
+    combined = pd.concat(partials, ignore_index=True)
+    combined[CURRENCY] = combined[CURRENCY].astype(object)
+    totals = combined.groupby([CURRENCY, "Date"], sort=True)[["sum", "count"]].sum()
+    table = (totals["sum"] / totals["count"]).rename(RATE).reset_index()
+    return table
+
+
+def as_of_rates(currencies, dates, table):
+    # Rate per row (see above); NaN for currencies without any rate and for
+    # rows without a date
+    n = len(currencies)
+    if table.empty or n == 0:
+        return np.full(n, np.nan)
+    known = pd.Index(table[CURRENCY].unique())
+    codes = known.get_indexer(pd.Series(currencies).astype(object))
+    table_codes = known.get_indexer(table[CURRENCY])
+    table_days = _days(table["Date"])
+    days = _days(dates)
+    has_day = days != np.iinfo(np.int64).min
+
+    # one sorted key per (currency, day): the table is sorted by currency
+    # and day, and known keeps the currencies in that order
+    first = min(table_days.min(), days[has_day].min() if has_day.any() else table_days.min())
+    last = max(table_days.max(), days[has_day].max() if has_day.any() else table_days.max())
+    span = last - first + 1
+    table_keys = table_codes * span + (table_days - first)
+    keys = codes * span + (np.where(has_day, days, first) - first)
+
+    before = np.searchsorted(table_keys, keys, side="right") - 1
+    after = np.minimum(before + 1, len(table_keys) - 1)
+    use_before = (before >= 0) & (table_codes[np.maximum(before, 0)] == codes)
+    use_after = ~use_before & (table_codes[after] == codes)
+    rates = table[RATE].to_numpy(dtype=float)
+    result = np.where(use_before, rates[np.maximum(before, 0)], np.where(use_after, rates[after], np.nan))
+    result[(codes < 0) | ~has_day] = np.nan
+    return result
@@ -0,0 +1,936 @@
+import time
+
+import pandas as pd
+
+from payload_cache import payload_cache, frame_columns, encode_column, columns
+from data_store import RATING_WINDOW, CRASHES_WINDOW, get_data, get_products
+from downsample import minmax_indices
+from watcher import start_watcher
+from offload import CallbackRunner
+import instrument
+
+# Bokeh imports
+from bokeh.plotting import figure
+from bokeh.models import (ColumnDataSource, Range1d, LinearAxis, Spinner, Select, HoverTool, Tabs, TabPanel,
+                          LogColorMapper, LinearColorMapper, DataTable, TableColumn, NumberFormatter, Div,
+                          DateRangeSlider)
+from bokeh.core.properties import value
+from bokeh.events import RangesUpdate
+from bokeh.layouts import row, column
+from bokeh.transform import factor_cmap, dodge, transform
+from bokeh.palettes import Plasma256, Viridis256
+
+# =====================================================================
+# Figures, sources and widgets of one dashboard
+# =====================================================================
+# A Dashboard builds its own figures, ColumnDataSources and widgets on top
+# of the shared (read-only) DashboardData from data_store. Every browser
+# session under `bokeh serve app.py` gets its own Dashboard; the static
+# export (export.py) builds one and writes it to HTML.
+# The callbacks are split in a part that computes a payload from the data
+# and a part that applies it to the models. In a server session the first
+# runs in a worker thread (see offload.py); until the dashboard has a
+# runner, e.g. while it is being built, both run straight away.
+THEME = "light_minimal"
+TITLE = "Emarald-IT Dashboard"
+EXPORT_TITLE = "Data Science Dashboard"
+# Largest moving-average window (days) selectable for p3
+MAX_WINDOW = 365
+# Widgets whose values a session keeps when its dashboard is rebuilt, in
+# the order they are restored: the SKU before the month and date range,
+# whose p2 (per SKU within the month) would otherwise be replaced by the
+# SKU's series over all months
+STATE_WIDGETS = ["select_sku", "select_overview", "date_range", "select_map", "select_country_p5",
+                 "rating_window", "crashes_window"]
+# Month filter entry shown while the date range is not a whole month
+CUSTOM_RANGE = "Custom Range"
+# Date ranges up to this many days are shown per day in p1, longer ones
+# per month
+MAX_DAILY_BARS = 92
+# How often an open Diagnostics tab is refreshed, and how many of the most
+# recent records it lists
+DIAGNOSTICS_REFRESH_MS = 2000
+DIAGNOSTICS_RECORDS = 200
+
+
+class Dashboard:
+    # products: the apps to offer in the app selector (hidden for one app)
+    # static: for the static export, which has no server to resample p3 on
+    # zoom, so p3 gets every row
+    @instrument.timed("dashboard.build")
+    def __init__(self, data, products=None, static=False):
+        self.data = data
+        self.runner = None
+        self.static = static
+        self._syncing_overview = False
+        products = products or [data.product_id]
+        if data.product_id not in products:
+            products = sorted(products + [data.product_id])
+        self.select_product = Select(title="App", value=data.product_id, options=products)
+        self.build_sales_volume()
+        self.build_sku_sales()
+        self.build_overview()
+        self.build_ratings_crashes()
+        self.build_world_map()
+        self.build_countries()
+        self.layout = self.build_layout()
+
+    # detail: the selection, recorded with the callback's timings
+    def run(self, channel, compute, apply, detail=None):
+        compute = instrument.traced(f"callback.{channel}", compute, detail)
+        apply = instrument.traced(f"callback.{channel}.apply", apply, detail)
+        if self.runner is None:
+            apply(compute())
+        else:
+            self.runner.run(channel, compute, apply)
+
+    # =====================================================================
+    # FIRST VISUALIZATION: Sales Volume Over Time (p1)
+    # =====================================================================
+    def build_sales_volume(self):
+        # Fetch data for this visualization
+        sales_by_month = self.data.sales_by_month
+
+        self.source_sales_by_month = ColumnDataSource(data=frame_columns(sales_by_month))
+        self.x_range_values = x_range_values = list(self.data.x_range_values)
+
+        # Visualization 1 styling
+        p1 = self.p1 = figure(
+            title="Sales Volume Over Time (All Months)",
+            x_range=x_range_values,
+            height=700, width=1400,
+            x_axis_label="Month",
+            y_axis_label="Transactions",
+            toolbar_location="right"
+        )
+
+        self.line_renderer = None
+
+        # Bars for transactions
+        self.bars_p1 = p1.vbar(
+            x="Month",
+            top="Transaction Count",
+            source=self.source_sales_by_month,
+            width=0.5,
+            fill_color=factor_cmap('Month', palette=Viridis256, factors=x_range_values),
+            line_color="black",
+            legend_label="Transactions"
+        )
+
+        max_amount = sales_by_month["Amount (Merchant Currency)"].max()
+        max_transactions = sales_by_month["Transaction Count"].max()
+        p1.extra_y_ranges = {"amount": Range1d(start=0, end=max_amount * 1.1)}
+        p1.y_range = Range1d(start=0, end=max_transactions * 1.1)  # Adjust the transaction axis
+        p1.add_layout(LinearAxis(y_range_name="amount", axis_label="Total Turnover (€)"), 'right')
+
+        self.add_trend_line()
+
+        hover = HoverTool(tooltips=[
+            ("Month", "@Month"),
+            ("Transactions", "@{Transaction Count}"),
+            ("Total Turnover (€)", "@{Amount (Merchant Currency)}{0.00}")
+        ])
+        p1.add_tools(hover)
+
+        p1.legend.location = "top_left"
+        p1.legend.click_policy = "hide"
+        p1.xaxis.major_label_orientation = 0.8
+        p1.ygrid.grid_line_color = None
+
+    # Ensure red line is added last so it's always on top (visible)
+    def add_trend_line(self):
+        p1 = self.p1
+        if self.line_renderer is not None and self.line_renderer in p1.renderers:
+            p1.renderers.remove(self.line_renderer)
+        self.line_renderer = p1.line(
+            x="Month",
+            y="Amount (Merchant Currency)",
+            source=self.source_sales_by_month,
+            color="firebrick",
+            line_width=3,
+            y_range_name="amount",
+            legend_label="Total Turnover"
+        )
+        p1.renderers.append(self.line_renderer)
+
+    # =====================================================================
+    # SECOND VISUALIZATION: Sales per SKU (p2)
+    # =====================================================================
+    def build_sku_sales(self):
+        # Fetch data for second visualization
+        unique_skus = list(self.data.unique_skus)
+        x_range_values = self.x_range_values
+
+        self.source_sku_filtered = ColumnDataSource(data=dict(Month=[], amount=[], count=[]))
+
+        # Second visualization styling
+        p2 = self.p2 = figure(
+            title="Sales per SKU (per Month)",
+            x_range=x_range_values,
+            height=700, width=1400,
+            x_axis_label="Month",
+            y_axis_label="Total Turnover (€)",
+            toolbar_location="right"
+        )
+
+        # Bars for the selected SKU's revenue
+        self.bars_p2 = p2.vbar(
+            x="Month",
+            top="amount",
+            source=self.source_sku_filtered,
+            width=0.5,
+            fill_color=factor_cmap('Month', palette=Viridis256, factors=x_range_values)
+            if len(x_range_values) > 1 else "dodgerblue",
+            line_color="black",
+            legend_label="SKU Turnover"
+        )
+
+        # Trendline for overall revenue in p2 (only in the All Months view)
+        self.line_renderer2 = None
+
+        # SKU filter (active only in the All Months view)
+        self.select_sku = Select(title="SKU filter", value=unique_skus[0], options=unique_skus)
+        self.select_sku.on_change("value", self.update_sku_plot)
+        self.source_sku_filtered.data = columns(self.cached_sku_payload(self.select_sku.value))
+
+        hover_sku = HoverTool(tooltips=[
+            ("Month", "@Month"),
+            ("Turnover (€)", "@amount{0.00}"),
+            ("Transactions", "@count")
+        ])
+        p2.add_tools(hover_sku)
+
+    def sku_payload(self, selected_sku):
+        sku_sales_df = self.data.sku_sales_df
+        df_filtered = sku_sales_df[sku_sales_df["Sku Id"] == selected_sku].copy()
+        df_filtered = df_filtered.set_index("Month").reindex(self.x_range_values, fill_value=0).reset_index()
+        df_filtered.rename(columns={"index": "Month"}, inplace=True)
+        return {"data": dict(
+            Month=encode_column(df_filtered["Month"]),
+            amount=encode_column(df_filtered["Amount (Merchant Currency)"]),
+            count=encode_column(df_filtered["Transaction Count"])
+        )}
+
+    def cached_sku_payload(self, selected_sku):
+        return payload_cache.get((self.data.version, "sku", selected_sku), lambda: self.sku_payload(selected_sku))
+
+    # The SKU has its own channel: on the "sales" channel a SKU change would
+    # replace a pending month or date range request and lose its p1/p2
+    def update_sku_plot(self, attr, old, new):
+        selected_sku = self.select_sku.value
+        self.run("sku", lambda: self.cached_sku_payload(selected_sku), self.apply_sku_plot, selected_sku)
+
+    def apply_sku_plot(self, payload):
+        # p2 only shows the SKU per month for All Months
+        if self.select_overview.value == "All Months":
+            self.source_sku_filtered.data = columns(payload)
+
+    # =====================================================================
+    # NEW DROPDOWN: "All Months" or Specific Month
+    # =====================================================================
+    def build_overview(self):
+        self.select_overview = Select(title="Month Filter", value="All Months",
+                                      options=self.overview_options("All Months"))
+        self.select_overview.on_change("value", self.update_overview)
+        self.build_date_range()
+
+    def overview_options(self, selected_overview):
+        # "Custom Range" is only offered while a custom range is selected
+        options = ["All Months"] + sorted(self.x_range_values)
+        return options + [CUSTOM_RANGE] if selected_overview == CUSTOM_RANGE else options
+
+    # Payloads for a month selection: p1 per day and p2 per SKU. Both are
+    # served from the precomputed per-month rollups of the sales cube
+    # (see data_store) and cached across sessions in payload_cache.
+    def overview_payload(self, selected_overview):
+        if selected_overview == "All Months":
+            return {"data": frame_columns(self.data.sales_by_month), "factors": list(self.x_range_values)}
+        sales_by_day = self.data.sales_by_day.get(selected_overview)
+        if sales_by_day is None:
+            return None
+        return {"data": frame_columns(sales_by_day), "factors": sales_by_day["Month"].tolist()}
+
+    def month_sku_payload(self, selected_overview):
+        df_month_sku = self.data.sku_sales_by_month.get(selected_overview)
+        if df_month_sku is None:
+            df_month_sku = self.data.sku_sales_df.iloc[:0]
+        return {"data": {
+            "Month": encode_column(df_month_sku["Sku Id"]),
+            "amount": encode_column(df_month_sku["Amount (Merchant Currency)"]),
+            "count": encode_column(df_month_sku["Transaction Count"])
+        }, "factors": df_month_sku["Sku Id"].tolist()}
+
+    def overview_payloads(self, selected_overview, selected_sku):
+        # (p1 payload, p2 payload) for a month selection
+        version = self.data.version
+        payload = payload_cache.get((version, "overview", selected_overview),
+                                    lambda: self.overview_payload(selected_overview))
+        if selected_overview == "All Months":
+            return payload, self.cached_sku_payload(selected_sku)
+        return payload, payload_cache.get((version, "month_sku", selected_overview),
+                                          lambda: self.month_sku_payload(selected_overview))
+
+    def update_overview(self, attr, old, new):
+        # A month (or All Months) moves the date range to it
+        selected_overview = self.select_overview.value
+        if self._syncing_overview or selected_overview == CUSTOM_RANGE:
+            return
+        self.select_overview.options = self.overview_options(selected_overview)
+        window = self.month_window(selected_overview)
+        if window is not None:
+            self.date_range.value = window
+        self.refresh_window(selected_overview)
+
+    # =====================================================================
+    # DATE RANGE: re-aggregates p1, p2, the map and p5 for a window of days
+    # =====================================================================
+    # Every total comes from the prefix sums of data.sales_index (see
+    # time_index.py), so a window costs two binary searches and a
+    # subtraction however many transactions there are. The Month Filter
+    # follows the range: a whole month selects that month, anything else
+    # "Custom Range".
+    def build_date_range(self):
+        index = self.data.sales_index
+        first, last = (index.first, index.last) if len(index) else (pd.Timestamp.today().normalize(),) * 2
+        self.date_range = DateRangeSlider(title="Date Range", start=first, end=last, value=(first, last), step=1,
+                                          format="%Y-%m-%d", width=600, disabled=len(index) < 2)
+        # value_throttled: only once the handle is released
+        self.date_range.on_change("value_throttled", self.update_window)
+
+    def window(self):
+        # The selected (start, end) days, clipped to the days with sales
+        index = self.data.sales_index
+        start, end = (_day(v) for v in self.date_range.value)
+        return max(start, index.first), min(end, index.last)
+
+    def window_key(self):
+        # window(), or None when it covers all sales
+        index = self.data.sales_index
+        if not len(index):
+            return None
+        start, end = self.window()
+        return None if start <= index.first and end >= index.last else (start, end)
+
+    def month_window(self, selected_overview):
+        # Date range of a Month Filter entry (None if it is no month)
+        index = self.data.sales_index
+        if not len(index):
+            return None
+        if selected_overview == "All Months":
+            return index.first, index.last
+        month = pd.Period(selected_overview, freq="M")
+        if month is pd.NaT:
+            return None
+        return max(month.start_time, index.first), min(month.end_time.normalize(), index.last)
+
+    def window_label(self, window):
+        if window is None:
+            return "All Months"
+        month = window[0].strftime("%Y-%m")
+        if month in self.x_range_values and self.month_window(month) == window:
+            return month
+        return CUSTOM_RANGE
+
+    def update_window(self, attr, old, new):
+        label = self.window_label(self.window_key())
+        self._syncing_overview = True
+        try:
+            # the option before the value when it is added, after when removed
+            if label == CUSTOM_RANGE:
+                self.select_overview.options = self.overview_options(label)
+            self.select_overview.value = label
+            self.select_overview.options = self.overview_options(label)
+        finally:
+            self._syncing_overview = False
+        self.refresh_window(label)
+
+    def refresh_window(self, label):
+        window, selected_sku = self.window_key(), self.select_sku.value
+        if label == CUSTOM_RANGE:
+            title = " to ".join(day.strftime("%Y-%m-%d") for day in window)
+            self.run("sales", lambda: (title, self.window_payloads(*window), None), self.apply_overview, title)
+        else:
+            self.run("sales", lambda: (label, self.overview_payloads(label, selected_sku), selected_sku),
+                     self.apply_overview, label)
+        self.update_map_sales()
+        self.update_p5(None, None, None)
+
+    def window_payloads(self, start, end):
+        # (p1 payload, p2 payload) for a custom date range: p1 per day (per
+        # month for long ranges), p2 per SKU
+        index = self.data.sales_index
+        if (end - start).days < MAX_DAILY_BARS:
+            sales = index.daily(start, end)
+            sales = sales.assign(Day=sales["Day"].dt.strftime("%Y-%m-%d")).rename(columns={"Day": "Month"})
+        else:
+            sales = index.monthly(start, end)
+        sku_sales = index.sku_totals(start, end)
+        return ({"data": frame_columns(sales), "factors": sales["Month"].tolist()},
+                {"data": {
+                    "Month": encode_column(sku_sales["Sku Id"]),
+                    "amount": encode_column(sku_sales["Amount (Merchant Currency)"]),
+                    "count": encode_column(sku_sales["Transaction Count"])
+                }, "factors": sku_sales["Sku Id"].tolist()})
+
+    def map_sales_payload(self, window):
+        # Sales per map country within the window (all time for None)
+        if window is None:
+            amounts = self.data.world_map["Amount (Merchant Currency)"]
+        else:
+            country_sales = self.data.sales_index.country_totals(*window).rename(columns={"Country": "Buyer Country"})
+            amounts = self.data.shapes.column(country_sales, "Buyer Country", "Amount (Merchant Currency)")
+        return {"amount": encode_column(amounts), "high": float(amounts.max()) if len(amounts) else 1.0}
+
+    def update_map_sales(self):
+        window = self.window_key()
+        self.run("map", lambda: payload_cache.get((self.data.version, "map_sales", window),
+                                                  lambda: self.map_sales_payload(window)),
+                 self.apply_map_sales, window)
+
+    def apply_map_sales(self, payload):
+        self.geo_source.data.update({"Amount (Merchant Currency)": payload["amount"]})
+        self.map_metrics["Sales Volume"]["mapper"].high = payload["high"]
+
+    def apply_overview(self, result):
+        p1, p2 = self.p1, self.p2
+        x_range_values = self.x_range_values
+        selected_overview, (payload, sku_payload), selected_sku = result
+        if selected_overview == "All Months":
+            # p1: restore monthly aggregation
+            p1.x_range.factors = x_range_values
+            self.source_sales_by_month.data = columns(payload)
+            p1.title.text = "Sales Volume Over Time (All Months)"
+            if len(x_range_values) == 1:
+                self.bars_p1.glyph.fill_color = "dodgerblue"
+            else:
+                self.bars_p1.glyph.fill_color = factor_cmap("Month", palette=Viridis256, factors=x_range_values)
+
+            # p2: restore monthly aggregation for SKU data
+            p2.x_range.factors = x_range_values
+            # a SKU picked meanwhile is on its way on the "sku" channel
+            if selected_sku == self.select_sku.value:
+                self.source_sku_filtered.data = columns(sku_payload)
+            p2.title.text = "Sales per SKU (per Month)"
+            self.select_sku.visible = True
+            if len(x_range_values) == 1:
+                self.bars_p2.glyph.fill_color = "dodgerblue"
+            else:
+                self.bars_p2.glyph.fill_color = factor_cmap("Month", palette=Viridis256, factors=x_range_values)
+
+            if self.line_renderer2 is None:
+                self.line_renderer2 = p2.line(
+                    x="Month",
+                    y="Amount (Merchant Currency)",
+                    source=self.source_sales_by_month,
+                    color="firebrick",
+                    line_width=3,
+                    legend_label="Total Turnover"
+                )
+                p2.renderers.append(self.line_renderer2)
+                hover_line = HoverTool(renderers=[self.line_renderer2],
+                                       tooltips=[("Month", "@Month"),
+                                                 ("Total Turnover (€)", "@{Amount (Merchant Currency)}{0.00}")])
+                p2.add_tools(hover_line)
+        else:
+            # Specific month selected:
+            # p1: aggregate by day for the selected month
+            if payload is not None:
+                day_list = payload["factors"]
+                p1.x_range.factors = day_list
+                self.source_sales_by_month.data = columns(payload)
+                p1.title.text = f"Sales Volume Over Time ({selected_overview})"
+                if len(day_list) == 1:
+                    self.bars_p1.glyph.fill_color = "dodgerblue"
+                else:
+                    self.bars_p1.glyph.fill_color = factor_cmap("Month", palette=Viridis256, factors=day_list)
+            else:
+                p1.x_range.factors = []
+                self.source_sales_by_month.data = {}
+                p1.title.text = f"Sales Volume Over Time ({selected_overview})"
+
+            # p2: aggregate by SKU for the selected month
+            sku_list_month = sku_payload["factors"]
+            p2.x_range.factors = sku_list_month
+            self.source_sku_filtered.data = columns(sku_payload)
+            p2.title.text = f"Sales per SKU ({selected_overview})"
+            if len(sku_list_month) == 1:
+                self.bars_p2.glyph.fill_color = "dodgerblue"
+            else:
+                self.bars_p2.glyph.fill_color = factor_cmap("Month", palette=Viridis256, factors=sku_list_month)
+            self.select_sku.visible = False
+            if self.line_renderer2 is not None:
+                try:
+                    p2.renderers.remove(self.line_renderer2)
+                except Exception:
+                    pass
+                self.line_renderer2 = None
+
+    # =====================================================================
+    # THIRD VISUALIZATION: Ratings vs. Crashes (p3)
+    # =====================================================================
+    def build_ratings_crashes(self):
+        # Fetch data for the third visualization
+        # (moving averages for better readability are computed and cached per
+        # window in data_store; Rating_MA/Crashes_MA hold the selected windows)
+        # The full series stay in p3_columns; the source only gets the rows
+        # needed for the visible date range (see refresh_ratings_crashes).
+        ratings_crashes = self.data.ratings_crashes[["Date", "Daily Crashes", "Daily Average Rating"]]
+        self.p3_columns = frame_columns(ratings_crashes)
+        self.p3_view = (None, None)
+        self.ratings_crashes_source = ColumnDataSource()
+        self.rating_window = Spinner(title="Rating MA window (days)", low=1, high=MAX_WINDOW, step=1,
+                                     value=RATING_WINDOW, width=200)
+        self.crashes_window = Spinner(title="Crashes MA window (days)", low=1, high=MAX_WINDOW, step=1,
+                                      value=CRASHES_WINDOW, width=200)
+
+        # Third visualization styling
+        p3 = self.p3 = figure(
+            title="Ratings vs. Crashes",
+            x_axis_label="Date",
+            y_axis_label="Crashes (7-day MA)",
+            x_axis_type="datetime",
+            height=700, width=1400,
+            toolbar_location="right",
+            background_fill_color="white"
+        )
+
+        # Fixed date range with the usual 5% padding, so that replacing the
+        # rows in the source on zoom does not move the range
+        dates = self.p3_columns["Date"]
+        if len(dates):
+            padding = (dates[-1] - dates[0]) * 0.05 or 86400000
+            p3.x_range = Range1d(start=dates[0] - padding, end=dates[-1] + padding)
+        p3.on_event(RangesUpdate, self.update_p3_range)
+
+        # Add a second y-axis for Average Rating (21-day MA)
+        p3.extra_y_ranges = {"rating": Range1d(start=0, end=5)}
+        self.rating_axis = LinearAxis(y_range_name="rating", axis_label="Average Rating (21-day MA)")
+        p3.add_layout(self.rating_axis, 'right')
+
+        # Draw the Crashes line in purple (solid)
+        self.crashes_line = p3.line(
+            x="Date",
+            y="Crashes_MA",
+            source=self.ratings_crashes_source,
+            color="purple",
+            line_width=3,
+            legend_label="Crashes (7-day MA)"
+        )
+
+        # Draw the Average Rating line in black (dashed)
+        self.rating_line = p3.line(
+            x="Date",
+            y="Rating_MA",
+            source=self.ratings_crashes_source,
+            color="black",
+            line_width=3,
+            line_dash="dashed",
+            y_range_name="rating",
+            legend_label="Average Rating (21-day MA)",
+            line_alpha=0.75
+        )
+
+        p3.legend.location = "top_left"
+        p3.legend.click_policy = "hide"
+        p3.xaxis.major_label_orientation = 0.8
+        p3.xgrid.grid_line_color = None
+        p3.ygrid.grid_line_color = None
+
+        self.hover_p3 = HoverTool(
+            renderers=[self.crashes_line, self.rating_line],
+            tooltips=[
+                ("Date", "@Date{%F}"),
+                ("Crashes (7-day MA)", "@Crashes_MA{0.0}"),
+                ("Average Rating (21-day MA)", "@Rating_MA{0.0}")
+            ],
+            formatters={"@Date": "datetime"}
+        )
+        p3.add_tools(self.hover_p3)
+
+        self.rating_window.on_change("value", self.update_moving_averages)
+        self.crashes_window.on_change("value", self.update_moving_averages)
+        self.update_moving_averages(None, None, None)
+
+    # Window changes and zooming share the "p3" channel and both recompute
+    # the source for the current windows and date range
+    def update_moving_averages(self, attr, old, new):
+        self.refresh_ratings_crashes()
+
+    def update_p3_range(self, event):
+        # Zoom/pan/reset: resample the lines for the new date range
+        self.p3_view = (event.x0, event.x1)
+        self.refresh_ratings_crashes()
+
+    def refresh_ratings_crashes(self):
+        windows = (self.rating_window.value, self.crashes_window.value)
+        view = self.p3_view
+        self.run("p3", lambda: self.ratings_crashes_payload(windows, view), self.apply_ratings_crashes,
+                 f"windows {windows}, view {view}")
+
+    def ratings_crashes_payload(self, windows, view):
+        rating_window, crashes_window = windows
+        full = dict(self.p3_columns)
+        full["Rating_MA"] = self.data.moving_average("Daily Average Rating", rating_window)
+        full["Crashes_MA"] = self.data.moving_average("Daily Crashes", crashes_window)
+        if self.static:
+            return windows, full, dict(full)
+        rows = minmax_indices(full["Date"], [full["Crashes_MA"], full["Rating_MA"]], *view)
+        return windows, full, {col: values[rows] for col, values in full.items()}
+
+    def apply_ratings_crashes(self, result):
+        (rating_window, crashes_window), self.p3_columns, data = result
+        self.ratings_crashes_source.data = data
+        crashes_label = f"Crashes ({crashes_window}-day MA)"
+        rating_label = f"Average Rating ({rating_window}-day MA)"
+        self.p3.left[0].axis_label = crashes_label
+        self.rating_axis.axis_label = rating_label
+        crashes_item, rating_item = self.p3.legend.items
+        crashes_item.label = value(crashes_label)
+        rating_item.label = value(rating_label)
+        self.hover_p3.tooltips = [
+            ("Date", "@Date{%F}"),
+            (crashes_label, "@Crashes_MA{0.0}"),
+            (rating_label, "@Rating_MA{0.0}")
+        ]
+
+    # =====================================================================
+    # FOURTH VISUALIZATION: World Map (Sales per Country)
+    # =====================================================================
+    def build_world_map(self):
+        # Fetch data fourth visualization
+        # (the simplified country shapes are loaded once in data_store, see geo.py)
+        # One source holds the shapes and a value column per metric; switching the
+        # metric only changes the colour field and mapper, no geometry is resent.
+        world_map = self.data.world_map
+        shapes = self.data.shapes
+        self.geo_source = ColumnDataSource(data=dict(xs=shapes.xs, ys=shapes.ys, **frame_columns(world_map)))
+
+        # Ensure that the colouring isnt favoured for the US to heavily
+        low_val = 1
+        high_val = world_map["Amount (Merchant Currency)"].max()
+        sales_color_mapper = LogColorMapper(palette=Plasma256, low=low_val, high=high_val)
+        rating_color_mapper = LinearColorMapper(palette=Plasma256, low=0, high=5)
+
+        # Metrics selectable for the map; a new one only needs a column in
+        # data.world_map and an entry here
+        self.map_metrics = {
+            "Sales Volume": {
+                "field": "Amount (Merchant Currency)",
+                "mapper": sales_color_mapper,
+                "title": "Geographical Distribution of Sales",
+                "tooltips": [("Country", "@ADMIN"), ("Sales (€)", "@{Amount (Merchant Currency)}{0.00}")],
+            },
+            "Total Average Rating": {
+                "field": "Total Average Rating",
+                "mapper": rating_color_mapper,
+                "title": "Geographical Distribution of Total Average Rating",
+                "tooltips": [("Country", "@ADMIN"), ("Rating", "@{Total Average Rating}{0.00}")],
+            },
+        }
+
+        # Fourth visualization styling
+        p4 = self.p4 = figure(
+            title="Geographical Distribution of Sales",
+            x_axis_type="mercator",
+            y_axis_type="mercator",
+            match_aspect=True,
+            height=700,
+            width=1400,
+            toolbar_location="right"
+        )
+
+        p4.xaxis.visible = False
+        p4.yaxis.visible = False
+
+        self.map_patches = p4.patches(
+            xs="xs",
+            ys="ys",
+            source=self.geo_source,
+            fill_color=transform("Amount (Merchant Currency)", sales_color_mapper),
+            fill_alpha=0.7,
+            line_color="gray",
+            line_width=0.5
+        )
+
+        self.hovertool = HoverTool(renderers=[self.map_patches],
+                                   tooltips=[("Country", "@ADMIN"),
+                                             ("Volume (€)", "@{Amount (Merchant Currency)}{0.00}")])
+        p4.add_tools(self.hovertool)
+        self.select_map = Select(title="Map Type", value="Sales Volume", options=list(self.map_metrics))
+        self.select_map.on_change("value", self.update_world_map)
+        self.update_world_map(None, None, None)
+
+    def update_world_map(self, attr, old, new):
+        metric = self.map_metrics[self.select_map.value]
+        self.map_patches.glyph.fill_color = transform(metric["field"], metric["mapper"])
+        self.p4.title.text = metric["title"]
+        self.hovertool.tooltips = metric["tooltips"]
+
+    # =====================================================================
+    # FIFTH VISUALIZATION: Transactions and Total Average Rating by Country (except the US)
+    # =====================================================================
+    def build_countries(self):
+        # Fetch data for the fifth visualization
+        country_data = self.data.country_data
+        countries = list(country_data["Country"])
+        self.source = ColumnDataSource(data=frame_columns(country_data))
+
+        max_transactions = country_data["Transactions"].max()
+
+        # Fifth visualization styling
+        p5 = self.p5 = figure(
+            x_range=countries,
+            title="Transactions and Total Average Rating by \"emerging\" Countries (except the US)",
+            height=600,
+            width=1200,
+            toolbar_location="right",
+            x_axis_label="Country",
+            y_range=Range1d(start=0, end=max_transactions * 1.1)
+        )
+
+        p5.vbar(
+            x=dodge('Country', -0.15, range=p5.x_range),
+            top='Transactions',
+            width=0.3,
+            source=self.source,
+            color="purple",
+            legend_label="Transactions"
+        )
+
+        p5.extra_y_ranges = {"rating": Range1d(start=0, end=5)}
+        p5.add_layout(LinearAxis(y_range_name="rating", axis_label="Total Average Rating"), 'right')
+
+        p5.vbar(
+            x=dodge('Country', 0.15, range=p5.x_range),
+            bottom=0,
+            top='Total Average Rating',
+            width=0.3,
+            source=self.source,
+            color="purple",
+            y_range_name="rating",
+            legend_label="Total Average Rating",
+            fill_alpha=0.25
+        )
+
+        p5.xgrid.grid_line_color = None
+        p5.legend.location = "top_left"
+        p5.legend.orientation = "horizontal"
+
+        hover_p5 = HoverTool(
+            tooltips=[
+                ("Country", "@Country"),
+                ("Transactions", "@Transactions{0,0}"),
+                ("Avg. Rating", "@{Total Average Rating}{0.00}")
+            ]
+        )
+        p5.add_tools(hover_p5)
+
+        unique_countries = ["All Countries"] + sorted(country_data["Country"].unique().tolist())
+        self.select_country_p5 = Select(title="Country Filter", value="All Countries", options=unique_countries)
+        self.select_country_p5.on_change("value", self.update_p5)
+        self.update_p5(None, None, None)
+
+    # window: (start, end) days of the transactions (None: all)
+    def p5_payload(self, selected_country, window=None):
+        if window is None:
+            country_data = self.data.country_data
+        else:
+            transactions = self.data.sales_index.country_totals(*window)
+            country_data = self.data.country_table(
+                transactions[["Country", "Transaction Count"]].rename(columns={"Transaction Count": "Transactions"}))
+        if selected_country == "All Countries":
+            filtered_data = country_data
+        else:
+            filtered_data = country_data[country_data["Country"] == selected_country]
+
+        max_filtered_transactions = filtered_data["Transactions"].max() if not filtered_data.empty else 1
+        return {"data": {
+            "Country": encode_column(filtered_data["Country"]),
+            "Transactions": encode_column(filtered_data["Transactions"]),
+            "Total Average Rating": encode_column(filtered_data["Total Average Rating"]),
+        }, "factors": filtered_data["Country"].tolist(), "y_end": max(max_filtered_transactions * 1.1, 10)}
+
+    def update_p5(self, attr, old, new):
+        selected_country, window = self.select_country_p5.value, self.window_key()
+        self.run("p5", lambda: payload_cache.get((self.data.version, "p5", selected_country, window),
+                                                 lambda: self.p5_payload(selected_country, window)),
+                 self.apply_p5, selected_country)
+
+    def apply_p5(self, payload):
+        self.source.data = columns(payload)
+        self.p5.x_range.factors = payload["factors"]
+        self.p5.y_range.end = payload["y_end"]
+
+    # =====================================================================
+    # LAYOUT (Tabs)
+    # =====================================================================
+    def build_layout(self):
+        tab1 = TabPanel(child=column(row(self.select_overview, self.date_range), self.p1), title="Sales Over Time")
+        tab2 = TabPanel(child=column(row(self.select_overview, self.select_sku, self.date_range), self.p2),
+                        title="Sales per SKU")
+        tab3 = TabPanel(child=column(row(self.rating_window, self.crashes_window), self.p3),
+                        title="Ratings vs. Crashes")
+        tab4 = TabPanel(child=column(row(self.select_map, self.date_range), self.p4), title="World Map")
+        tab5 = TabPanel(child=column(row(self.select_country_p5, self.date_range), self.p5),
+                        title="View per country")
+        tabs = [tab1, tab2, tab3, tab4, tab5]
+        if instrument.diagnostics:
+            tabs.append(TabPanel(child=self.build_diagnostics(), title="Diagnostics"))
+        self.tabs = Tabs(tabs=tabs)
+        if len(self.select_product.options) > 1:
+            return column(self.select_product, self.tabs)
+        return self.tabs
+
+    # =====================================================================
+    # DIAGNOSTICS (optional): timings per stage and callback, see instrument.py
+    # =====================================================================
+    def build_diagnostics(self):
+        self.stages_source = ColumnDataSource()
+        self.records_source = ColumnDataSource()
+        seconds = NumberFormatter(format="0.000")
+        megabytes = NumberFormatter(format="0.0")
+        stages_table = DataTable(source=self.stages_source, width=1400, height=350, index_position=None, columns=[
+            TableColumn(field="name", title="Stage", width=300),
+            TableColumn(field="count", title="Calls"),
+            TableColumn(field="seconds", title="Total (s)", formatter=seconds),
+            TableColumn(field="mean_seconds", title="Mean (s)", formatter=seconds),
+            TableColumn(field="max_seconds", title="Max (s)", formatter=seconds),
+            TableColumn(field="last_rows", title="Last rows"),
+            TableColumn(field="last_rss_delta_mb", title="Last RSS change (MB)", formatter=megabytes),
+        ])
+        records_table = DataTable(source=self.records_source, width=1400, height=350, index_position=None, columns=[
+            TableColumn(field="time", title="Time"),
+            TableColumn(field="name", title="Stage", width=300),
+            TableColumn(field="detail", title="Selection", width=300),
+            TableColumn(field="seconds", title="Seconds", formatter=seconds),
+            TableColumn(field="rows", title="Rows"),
+            TableColumn(field="rss_delta_mb", title="RSS change (MB)", formatter=megabytes),
+            TableColumn(field="thread", title="Thread"),
+        ])
+        self.diagnostics_memory = Div()
+        self.refresh_diagnostics()
+        return column(self.diagnostics_memory, stages_table, Div(text="<b>Most recent</b>"), records_table)
+
+    def refresh_diagnostics(self):
+        snapshot = instrument.snapshot()
+        cache = snapshot["payload_cache"]
+        self.diagnostics_memory.text = (f"<b>RSS</b> {snapshot['rss_mb']} MB, <b>peak</b> {snapshot['max_rss_mb']} MB"
+                                        f" (process {snapshot['pid']})<br><b>Payload cache</b> {cache['entries']} "
+                                        f"entries, {cache['bytes'] / 2**20:.1f} of {cache['max_bytes'] / 2**20:.0f} MB, "
+                                        f"{cache['hits']} hits, {cache['misses']} misses ({cache['hit_rate']:.0%}), "
+                                        f"{cache['evictions']} evictions")
+        stages = sorted(snapshot["stages"].items(), key=lambda item: -item[1]["seconds"])
+        self.stages_source.data = {
+            "name": [name for name, _ in stages],
+            "count": [stats["count"] for _, stats in stages],
+            "seconds": [stats["seconds"] for _, stats in stages],
+            "mean_seconds": [stats["seconds"] / stats["count"] for _, stats in stages],
+            "max_seconds": [stats["max_seconds"] for _, stats in stages],
+            "last_rows": [_missing(stats["last_rows"]) for _, stats in stages],
+            "last_rss_delta_mb": [_missing(stats["last_rss_delta_mb"]) for _, stats in stages],
+        }
+        records = snapshot["records"][::-1][:DIAGNOSTICS_RECORDS]
+        self.records_source.data = {
+            "time": [time.strftime("%H:%M:%S", time.localtime(r["time"])) for r in records],
+            "name": [r["name"] for r in records],
+            "detail": [r["detail"] or "" for r in records],
+            "seconds": [r["seconds"] for r in records],
+            "rows": [_missing(r["rows"]) for r in records],
+            "rss_delta_mb": [_missing(r["rss_delta_mb"]) for r in records],
+            "thread": [r["thread"] for r in records],
+        }
+
+    def diagnostics_visible(self):
+        return instrument.diagnostics and self.tabs.active == len(self.tabs.tabs) - 1
+
+    def widget_state(self):
+        state = {name: getattr(self, name).value for name in STATE_WIDGETS}
+        state["tab"] = self.tabs.active
+        return state
+
+    def restore_state(self, state):
+        # Apply a widget_state() of another dashboard; selections that do not
+        # exist in this one (e.g. a month that is not in the data) are skipped.
+        # The date range is only kept when it was no month (or all of them),
+        # so "All Months" still covers the data after a reload.
+        custom_range = state.get("select_overview") == CUSTOM_RANGE
+        for name in STATE_WIDGETS:
+            widget = getattr(self, name)
+            if name not in state or (isinstance(widget, Select) and state[name] not in widget.options):
+                continue
+            if name == "date_range" and not custom_range:
+                continue
+            widget.value = state[name]
+        if custom_range and "date_range" in state:
+            # value_throttled only fires for changes from the browser
+            self.update_window(None, None, None)
+        self.tabs.active = state.get("tab", 0)
+
+
+def _missing(value):
+    return float("nan") if value is None else value
+
+
+def _day(value):
+    # A DateRangeSlider value (ms since the epoch, or a date) as a day
+    if isinstance(value, (int, float)):
+        return pd.Timestamp(value, unit="ms").normalize()
+    return pd.Timestamp(value).normalize()
+
+
+@instrument.timed("dashboard.show")
+def show_dashboard(doc, dashboard):
+    # Make the dashboard the (only) content of a Bokeh document
+    doc.clear()
+    doc.add_root(dashboard.layout)
+    doc.theme = THEME
+    doc.title = TITLE
+
+
+def build_dashboard(product_id=None, state=None, reload=True):
+    # Dashboard of product_id on the shared data, with the widget_state()
+    # of a previous dashboard applied
+    dashboard = Dashboard(get_data(product_id=product_id, reload=reload), get_products(reload=reload))
+    if state:
+        dashboard.restore_state(state)
+    return dashboard
+
+
+def serve_dashboard(doc, product_id=None):
+    # Show the dashboard of product_id in a server session. Picking another
+    # app replaces it with that app's dashboard, built on the app's own
+    # (shared, cached) DashboardData; when the watcher reloaded the data the
+    # dashboard is rebuilt on the new data. Both keep the widget state and
+    # build the new dashboard in the callback pool.
+    # With the watcher running, only the watcher reloads data; sessions
+    # take what is loaded.
+    watcher = start_watcher()
+    instrument.start_server()
+    reload = watcher is None
+    runner = CallbackRunner(doc)
+    session = {}
+
+    def show(dashboard):
+        dashboard.runner = runner
+        dashboard.select_product.on_change("value", lambda attr, old, new: rebuild(new))
+        if watcher is not None:
+            watcher.subscribe(doc, dashboard.data.product_id, lambda data: rebuild(data.product_id))
+        session["dashboard"] = dashboard
+        show_dashboard(doc, dashboard)
+
+    def rebuild(product_id):
+        state = session["dashboard"].widget_state()
+        runner.run("dashboard", instrument.traced("callback.dashboard",
+                                                  lambda: build_dashboard(product_id, state, reload), product_id),
+                   show)
+
+    def refresh_diagnostics():
+        if session["dashboard"].diagnostics_visible():
+            session["dashboard"].refresh_diagnostics()
+
+    show(build_dashboard(product_id, reload=reload))
+    if instrument.diagnostics:
+        doc.add_periodic_callback(refresh_diagnostics, DIAGNOSTICS_REFRESH_MS)
+    if watcher is not None:
+        doc.on_session_destroyed(lambda session_context: watcher.unsubscribe(doc))
+    return session["dashboard"]
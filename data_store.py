@@ -0,0 +1,324 @@
+import pandas as pd
+import glob
+import hashlib
+import itertools
+import os
+import threading
+
+from ingest import PRODUCT_ID, finish_sales, finish_crashes, finish_ratings
+from currency import merge_rates
+from time_index import SalesIndex
+from ingest_cache import IngestCache
+import archive
+from instrument import timed
+from geo import load_shapes
+from aggregates import (sales_partials, cube_partials, crash_partials, ratings_partials, merge_sales, merge_cube,
+                        merge_ratings_crashes, merge_country_ratings, merge_latest_ratings, update_rolling)
+
+# =====================================================================
+# Process-wide data layer
+# =====================================================================
+# `bokeh serve app.py` runs app.py again for every browser session, but the
+# modules it imports stay in sys.modules. Everything in here is therefore
+# loaded and aggregated once per server process and shared between sessions.
+# The tables are shared read-only: sessions must never modify them in place,
+# they only build their own figures and ColumnDataSources on top of them.
+data_path = os.path.join(os.getcwd(), "data")
+shapefile_path = os.path.join(os.getcwd(), "worldmap", "ne_110m_admin_0_countries.shp")
+# Normalised exports are cached here as Feather files (see ingest_cache)
+cache_path = os.path.join(os.getcwd(), "cache")
+# Number of processes that parse CSVs missing from the cache in parallel
+ingest_workers = int(os.environ.get("INGEST_WORKERS", "1"))
+# The app shown by default; the data of every app is kept apart per product
+default_product_id = os.environ.get("DASHBOARD_PRODUCT_ID", PRODUCT_ID)
+# Where the aggregates are computed: "pandas" loads the exports of a
+# product into memory, "duckdb" aggregates them out of core from the ingest
+# cache (see archive.py) and keeps no frames
+data_backend = os.environ.get("DATA_BACKEND", "pandas")
+
+_lock = threading.Lock()
+# Shared DashboardData per product: {product: {"key", "data"}}
+_cache = {}
+# Ingest state kept between reloads: per source file its signature, kind,
+# content hash and products, and per product its partial aggregates (see
+# aggregates.py), so that a reload only has to touch the files that are new
+# or changed, and a product is only loaded when shown. Only the sales
+# exports without rates keep their rows (as read from the cache): they are
+# converted again whenever the rate table changes.
+_files = {}
+_state = {}
+# Every DashboardData gets a new version, used to key derived caches
+_versions = itertools.count(1)
+# Default moving-average windows (days) of p3 and the reports
+RATING_WINDOW = 21
+CRASHES_WINDOW = 7
+
+
+def _file_signature(paths):
+    # (path, mtime, size) per file, used to notice added/changed/removed files
+    signature = []
+    for path in sorted(paths):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        signature.append((path, stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+
+@timed("data.sync_files")
+def sync_files(csv_files, cache_path=cache_path, workers=ingest_workers):
+    # Bring _files in line with csv_files. New or changed exports are parsed
+    # once, for all products, into the partitioned cache (see ingest_cache).
+    signature = {path: (mtime, size) for path, mtime, size in _file_signature(csv_files)}
+    for path in list(_files):
+        if path not in signature:
+            del _files[path]
+
+    changed = [path for path in csv_files if path in signature
+               and (path not in _files or _files[path]["signature"] != signature[path])]
+    if changed:
+        cache = IngestCache(cache_path)
+        for path, (kind, partitions) in zip(changed, cache.load_many(changed, workers)):
+            _files[path] = {"signature": signature[path], "kind": kind, "rates": cache.read_rates(path),
+                            "hash": cache.manifest["files"][path]["hash"],
+                            "products": {product for product, _ in partitions}, "by_product": {}}
+        cache.prune(list(signature))
+        cache.save_manifest()
+
+
+def rates_key(csv_files):
+    # Version of the rate table of csv_files: the content hashes of the
+    # exports with rates it is merged from, in file order
+    digest = hashlib.sha1()
+    for path in csv_files:
+        if path in _files and _files[path]["rates"] is not None:
+            digest.update(_files[path]["hash"].encode())
+    return digest.hexdigest()
+
+
+def current_rate_table(csv_files):
+    # The rate table of csv_files (see currency.py)
+    return merge_rates([_files[path]["rates"] for path in csv_files if path in _files])
+
+
+def normalised_frame(cache, entry, product_id, rate_table):
+    # The rows of product_id in the entry's export as finish_*() makes them
+    raw = entry.get("raw")
+    if raw is None:
+        raw = cache.read_product(entry["path"], product_id)
+    if entry["kind"] == "sales":
+        # kept, to be converted again when the rate table changes
+        if not entry["has_rates"]:
+            entry["raw"] = raw
+        return finish_sales(raw, rate_table)
+    if entry["kind"] == "crashes":
+        return finish_crashes(raw)
+    return finish_ratings(raw)
+
+
+def _partials(cache, entry, product_id, rate_table, backend):
+    # (rows, partials) of an entry, computed from its rows in the cache
+    if backend == "duckdb":
+        source = archive.entry(entry["kind"], cache.product_paths(entry["path"], product_id))
+        return source["rows"], archive.partials(source, rate_table)
+    frame = normalised_frame(cache, entry, product_id, rate_table)
+    if entry["kind"] == "sales":
+        partials = sales_partials(frame)
+        partials["cube"] = cube_partials(frame)
+    elif entry["kind"] == "crashes":
+        partials = crash_partials(frame)
+    else:
+        partials = ratings_partials(frame)
+    return len(frame), partials
+
+
+@timed("data.product_entries")
+def product_entries(csv_files, product_id, cache_path=cache_path, backend=data_backend):
+    # The per-file entries of product_id (row count and partials), in file
+    # order. The partials of every export are stored in the ingest cache
+    # (see IngestCache.read_partials), so an export's rows are only read
+    # when it is new or changed, or when it is a sales export without rates
+    # and the rate table changed.
+    cache = IngestCache(cache_path)
+    entries = []
+    for path in csv_files:
+        file = _files.get(path)
+        if file is None or product_id not in file["products"]:
+            continue
+        if product_id not in file["by_product"]:
+            file["by_product"][product_id] = {"kind": file["kind"], "path": path,
+                                              "has_rates": file["rates"] is not None}
+        entries.append(file["by_product"][product_id])
+
+    # The aberrant sales formats are converted with the daily rates of the
+    # sales exports of all apps (see currency.py), so their partials are
+    # keyed by the version of that rate table as well.
+    key = rates_key(csv_files)
+    table = None
+    for entry in entries:
+        entry_key = (backend, key if entry["kind"] == "sales" and not entry["has_rates"] else None)
+        if entry.get("key") == entry_key:
+            continue
+        stored = cache.read_partials(entry["path"], product_id, *entry_key)
+        if stored is None:
+            if table is None:
+                table = current_rate_table(csv_files)
+            stored = _partials(cache, entry, product_id, table, backend)
+            cache.write_partials(entry["path"], product_id, *entry_key, stored)
+        entry["rows"], entry["partials"] = stored
+        entry["key"] = entry_key
+    return entries
+
+
+class DashboardData:
+    # Every aggregate that does not depend on a session's widget state,
+    # computed once and shared by all sessions.
+    # The aggregates are merged from the per-file partials; `previous` is
+    # the DashboardData being replaced, whose moving averages are reused
+    # for the days that did not change. Without shapes (headless reports,
+    # see queries.py) the dashboard-only tables are skipped: the sales cube
+    # with its month drill-downs and the world map are left None. Both
+    # backends give the same aggregates.
+    @timed("data.dashboard_data")
+    def __init__(self, entries, shapes, previous=None, product_id=default_product_id):
+        self.version = next(_versions)
+        self.product_id = product_id
+        sales_parts = [e["partials"] for e in entries if e["kind"] == "sales"]
+        crash_parts = [e["partials"] for e in entries if e["kind"] == "crashes"]
+        rating_parts = [e["partials"] for e in entries if e["kind"] == "ratings"]
+
+        self.shapes = shapes
+        sales = merge_sales(sales_parts)
+
+        # p1: sales per month
+        self.sales_by_month = sales["sales_by_month"]
+        self.x_range_values = self.sales_by_month["Month"].tolist()
+
+        # p2: sales per SKU per month
+        self.sku_sales_df = sales["sku_sales_df"]
+        self.unique_skus = sorted(self.sku_sales_df["Sku Id"].unique().tolist())
+
+        # p1/p2 month drill-down: sales cube and its per-month rollups and
+        # the date index behind the date-range selection (see time_index)
+        self.sales_cube = self.sales_by_day = self.sku_sales_by_month = self.sales_index = None
+        if shapes is not None:
+            cube = merge_cube([p["cube"] for p in sales_parts])
+            self.sales_cube = cube["sales_cube"]
+            self.sales_by_day = cube["sales_by_day"]
+            self.sku_sales_by_month = cube["sku_sales_by_month"]
+            self.sales_index = SalesIndex(self.sales_cube)
+
+        # p3: ratings vs. crashes with moving averages. Every window used so
+        # far (see moving_average) is brought up to date incrementally.
+        self.ratings_crashes = merge_ratings_crashes(crash_parts, rating_parts)
+        self.moving_averages = {}
+        windows = {("Daily Average Rating", RATING_WINDOW), ("Daily Crashes", CRASHES_WINDOW)}
+        if previous is not None:
+            windows |= set(previous.moving_averages)
+        for col, window in sorted(windows):
+            self.moving_average(col, window, previous)
+        self.ratings_crashes["Rating_MA21"] = self.moving_average("Daily Average Rating", RATING_WINDOW)
+        self.ratings_crashes["Crashes_MA7"] = self.moving_average("Daily Crashes", CRASHES_WINDOW)
+
+        # p4: one value column per map metric, in the order of the shared
+        # country shapes (see geo.py)
+        country_sales = sales["country_sales"]
+        self.country_sales = country_sales
+        ratings_per_country, country_ratings_latest = merge_country_ratings(rating_parts)
+        self.ratings_per_country = ratings_per_country
+        # the ratings row of every country's most recent day (reports)
+        self.latest_ratings = merge_latest_ratings(rating_parts)
+        self.world_map = None
+        if shapes is not None:
+            world_map = shapes.attributes.copy()
+            world_map["Amount (Merchant Currency)"] = shapes.column(country_sales, "Buyer Country", "Amount (Merchant Currency)")
+            world_map["Total Average Rating"] = shapes.column(country_ratings_latest, "Country", "Total Average Rating")
+            self.world_map = world_map
+
+        # p5: transactions and latest rating per country (except the US)
+        transactions_per_country = sales["transactions_per_country"]
+        self.transactions_per_country = transactions_per_country
+
+        self.country_data = self.country_table(transactions_per_country)
+
+    def country_table(self, transactions_per_country):
+        # p5 rows: the countries with transactions (except the US) with their
+        # latest rating, most transactions first
+        country_data = pd.merge(transactions_per_country, self.ratings_per_country, on="Country", how="outer")
+        country_data["Transactions"] = country_data["Transactions"].fillna(0)
+        country_data["Total Average Rating"] = country_data["Total Average Rating"].fillna(0)
+        country_data = country_data[(country_data["Transactions"] > 0) & (country_data["Country"] != "US")]
+        return country_data.sort_values(by="Transactions", ascending=False)
+
+    def moving_average(self, column, window, previous=None):
+        # Rolling mean of ratings_crashes[column] over `window` days, computed
+        # once per window and shared by all sessions; `previous` (the data
+        # being replaced) provides the values for the days that did not change.
+        key = (column, window)
+        if key not in self.moving_averages:
+            previous_rc = previous.ratings_crashes if previous is not None else None
+            previous_mean = previous.moving_averages.get(key) if previous is not None else None
+            mean = update_rolling(self.ratings_crashes, previous_rc, column, window, previous_mean)
+            mean.flags.writeable = False
+            self.moving_averages[key] = mean
+        return self.moving_averages[key]
+
+
+def _csv_files(data_path):
+    return sorted(glob.glob(os.path.join(data_path, "*.csv")))
+
+
+def get_data(data_path=data_path, shapefile_path=shapefile_path, cache_path=cache_path,
+             workers=ingest_workers, product_id=None, dashboard=True, reload=True, backend=data_backend):
+    # Return the shared DashboardData of product_id (default:
+    # default_product_id), (re)loading it only when a CSV in data_path or the
+    # shapefile was added, changed or removed since the last call. The lock
+    # makes concurrent sessions wait for a single load.
+    # dashboard=False skips the shapefile and the dashboard-only tables.
+    # reload=False returns the data already loaded (if any) without looking
+    # at the files, for when the watcher (see watcher.py) does the reloads.
+    product_id = product_id or default_product_id
+    cached = _cache.get(product_id)
+    if not reload and cached is not None and cached["data"] is not None:
+        return cached["data"]
+    csv_files = _csv_files(data_path)
+    shapes_key = _file_signature([shapefile_path]) if dashboard else None
+    key = (_file_signature(csv_files), shapes_key)
+    with _lock:
+        cached = _cache.setdefault(product_id, {"key": None, "data": None})
+        if cached["key"] != key:
+            sync_files(csv_files, cache_path, workers)
+            entries = product_entries(csv_files, product_id, cache_path, backend)
+            if dashboard and _state.get("shapes_key") != shapes_key:
+                _state["shapes"] = load_shapes(shapefile_path, cache_path)
+                _state["shapes_key"] = shapes_key
+            shapes = _state["shapes"] if dashboard else None
+            cached["data"] = DashboardData(entries, shapes, cached["data"], product_id)
+            cached["key"] = key
+        return cached["data"]
+
+
+def get_products(data_path=data_path, cache_path=cache_path, workers=ingest_workers, reload=True):
+    # The products with sales in data_path, sorted (reload: as in get_data)
+    csv_files = _csv_files(data_path)
+    if reload or not _files:
+        with _lock:
+            sync_files(csv_files, cache_path, workers)
+    files = dict(_files)
+    return sorted({product for path in csv_files if path in files and files[path]["kind"] == "sales"
+                   for product in files[path]["products"]})
+
+
+def loaded_products():
+    # The products with shared data loaded in this process
+    return [product for product, cached in list(_cache.items()) if cached["data"] is not None]
+
+
+def reset():
+    # Forget everything loaded in this process (the Feather cache on disk
+    # stays), e.g. to measure a cold start again (see benchmark.py)
+    with _lock:
+        _cache.clear()
+        _files.clear()
+        _state.clear()
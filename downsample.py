@@ -0,0 +1,38 @@
+import numpy as np
+import os
+
+# =====================================================================
+# Level-of-detail downsampling for long time series
+# =====================================================================
+# Years of daily values give far more points than a 1400 px wide plot can
+# show. minmax_indices() splits the visible x-range into buckets and keeps,
+# per bucket, the rows with the minimum and the maximum of every plotted
+# column, so peaks and dips survive. All columns share the same rows (one
+# x column per ColumnDataSource). Zooming in means fewer rows per bucket,
+# until every row in view is sent; the full series stays on the server.
+max_points = int(os.environ.get("DOWNSAMPLE_POINTS", "2000"))
+
+
+def minmax_indices(x, ys, start=None, end=None, max_points=max_points):
+    # Sorted row indices to draw the columns ys against the ascending x
+    # between start and end (None: all rows) with at most about max_points
+    # points. The nearest row outside the range on either side is included
+    # so lines run up to the edges of the plot.
+    n = len(x)
+    lo = 0 if start is None else max(int(np.searchsorted(x, start, "left")) - 1, 0)
+    hi = n if end is None else min(int(np.searchsorted(x, end, "right")) + 1, n)
+    if hi - lo <= max_points:
+        return np.arange(lo, hi)
+
+    buckets = max(max_points // (2 * len(ys)), 1)
+    xs = x[lo:hi]
+    span = (xs[-1] - xs[0]) or 1
+    bucket = np.minimum(((xs - xs[0]) / span * buckets).astype(np.int64), buckets - 1)
+    picked = [np.array([lo, hi - 1])]
+    for y in ys:
+        values = np.asarray(y[lo:hi], dtype=float)
+        # within each bucket the smallest (largest) value comes first; NaN last
+        for order in (np.lexsort((values, bucket)), np.lexsort((-values, bucket))):
+            first = np.r_[True, bucket[order][1:] != bucket[order][:-1]]
+            picked.append(lo + order[first])
+    return np.unique(np.concatenate(picked))
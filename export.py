@@ -0,0 +1,243 @@
+import numpy as np
+import argparse
+import gzip
+import json
+import os
+import re
+import struct
+
+from bokeh.document import Document
+from bokeh.embed import file_html
+from bokeh.models import ColumnDataSource, CustomJS
+from bokeh.resources import CDN
+from bokeh.io import curdoc
+
+from atomic import write_atomic
+from data_store import get_data
+from dashboard import Dashboard, show_dashboard, EXPORT_TITLE
+from instrument import stage, timed
+
+# =====================================================================
+# Static HTML export
+# =====================================================================
+# By default the dashboard is written as one HTML file with every data
+# source inlined. Two options make it smaller:
+#   - sidecar: the HTML only holds the layout; the columns of all data
+#     sources go to a gzip-compressed binary file next to it, which the page
+#     fetches and unpacks on load. The page then has to be served over
+#     http(s) next to its sidecar (browsers block fetch() from file://);
+#     when the fetch fails the page says so.
+#   - aggregated_only: only the columns that are actually drawn or shown in
+#     a tooltip are exported (so no raw daily values, ISO codes, ...).
+# export_dashboard() returns the size in bytes of every file it wrote.
+#
+# Run with `python export.py [--sidecar] [--aggregated-only] [-o file]`.
+SIDECAR_SUFFIX = ".data.gz"
+
+# Typed arrays the sidecar loader can create in the browser
+_TYPED_ARRAYS = {"float32", "float64", "int8", "int16", "int32", "uint8", "uint16", "uint32"}
+
+_LOADER = """
+const fail = (error) => {
+    console.error(error);
+    const message = document.createElement("div");
+    message.textContent = `Could not load the dashboard data from ${url}: ${error.message}`;
+    message.style.cssText = "position: fixed; top: 0; left: 0; right: 0; z-index: 1000; padding: 1em; " +
+                            "background: #fdecea; color: #a61b1b; font: 14px sans-serif";
+    document.body.appendChild(message);
+};
+fetch(url)
+    .then((response) => {
+        if (!response.ok) {
+            throw new Error(`${response.status} ${response.statusText}`);
+        }
+        return response.arrayBuffer();
+    })
+    .then((buffer) => {
+        // Served with Content-Encoding: gzip the browser has unpacked it already
+        const magic = new Uint8Array(buffer, 0, Math.min(buffer.byteLength, 3));
+        if (magic.length < 3 || magic[0] !== 0x1f || magic[1] !== 0x8b || magic[2] !== 0x08) {
+            return buffer;
+        }
+        return new Response(new Blob([buffer]).stream().pipeThrough(new DecompressionStream("gzip"))).arrayBuffer();
+    })
+    .then((buffer) => {
+        const size = new DataView(buffer).getUint32(0, true);
+        const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 4, size)));
+        const base = 4 + size + (8 - (4 + size) % 8) % 8;
+        const types = {float32: Float32Array, float64: Float64Array, int8: Int8Array, int16: Int16Array,
+                       int32: Int32Array, uint8: Uint8Array, uint16: Uint16Array, uint32: Uint32Array};
+        const view = (e) => new types[e.dtype](buffer, base + e.offset, e.length);
+        for (const [id, columns] of Object.entries(header)) {
+            const data = {};
+            for (const [name, e] of Object.entries(columns)) {
+                if (e.list !== undefined) {
+                    data[name] = e.list;
+                } else if (e.ragged !== undefined) {
+                    const flat = view(e.ragged);
+                    const offsets = view(e.offsets);
+                    data[name] = Array.from({length: offsets.length - 1}, (_, i) => flat.subarray(offsets[i], offsets[i + 1]));
+                } else {
+                    data[name] = view(e);
+                }
+            }
+            sources[id].data = data;
+        }
+    })
+    .catch(fail);
+"""
+
+
+def _write_bytes(path, data):
+    def write(tmp_path):
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+    write_atomic(path, write)
+
+
+def _typed(values):
+    # values as an array the browser can view directly, or None
+    array = np.asarray(values)
+    if array.dtype.kind not in "fiu":
+        return None
+    if array.dtype.name not in _TYPED_ARRAYS:
+        array = array.astype(np.float64)
+    return np.ascontiguousarray(array)
+
+
+def _plain(values):
+    return [v.item() if isinstance(v, np.generic) else v for v in values]
+
+
+@timed("export.encode_sidecar")
+def encode_sidecar(sources):
+    # Layout: uint32 header size, JSON header, padding to 8 bytes, then the
+    # (8-byte aligned) array buffers the header points into.
+    header = {}
+    buffers = []
+    offset = 0
+
+    def add(array):
+        nonlocal offset
+        padding = (-offset) % 8
+        if padding:
+            buffers.append(b"\0" * padding)
+            offset += padding
+        entry = {"dtype": array.dtype.name, "offset": offset, "length": len(array)}
+        buffers.append(array.tobytes())
+        offset += array.nbytes
+        return entry
+
+    for source in sources:
+        columns = {}
+        for name, values in source.data.items():
+            array = _typed(values) if isinstance(values, np.ndarray) else None
+            parts = [_typed(v) for v in values] if array is None and len(values) and all(
+                isinstance(v, np.ndarray) for v in values) else None
+            if array is not None and array.ndim == 1:
+                columns[name] = add(array)
+            elif parts is not None and all(p is not None and p.ndim == 1 for p in parts):
+                # ragged columns (xs/ys of patches): one flat array + offsets
+                offsets = np.zeros(len(parts) + 1, dtype=np.int32)
+                offsets[1:] = np.cumsum([len(p) for p in parts])
+                flat = np.concatenate(parts).astype(np.result_type(*parts))
+                columns[name] = {"ragged": add(flat), "offsets": add(offsets)}
+            else:
+                columns[name] = {"list": _plain(values)}
+        header[source.id] = columns
+
+    header_bytes = json.dumps(header).encode()
+    start = 4 + len(header_bytes)
+    head = struct.pack("<I", len(header_bytes)) + header_bytes + b"\0" * ((-start) % 8)
+    return gzip.compress(head + b"".join(buffers), compresslevel=9)
+
+
+def used_columns(models):
+    # Column names referenced by glyphs (fields, incl. transforms such as
+    # factor_cmap/dodge) and by hover tooltips
+    used = set()
+    for model in models:
+        for value in model.properties_with_values(include_defaults=False).values():
+            field = getattr(value, "field", None)
+            if isinstance(field, str):
+                used.add(field)
+            elif isinstance(value, dict) and isinstance(value.get("field"), str):
+                used.add(value["field"])
+        tooltips = getattr(model, "tooltips", None)
+        if isinstance(tooltips, list):
+            for _, text in tooltips:
+                for braced, plain in re.findall(r"@\{([^}]+)\}|@(\w+)", text):
+                    used.add(braced or plain)
+    return used
+
+
+def export_dashboard(root, path="dashboard.html", title=EXPORT_TITLE,
+                     sidecar=False, aggregated_only=False):
+    doc = root.document
+    temporary_doc = doc is None
+    if temporary_doc:
+        doc = Document()
+        doc.add_root(root)
+    models = list(root.references())
+    sources = [m for m in models if isinstance(m, ColumnDataSource)]
+    original_data = {source.id: dict(source.data) for source in sources}
+    sidecar_path = os.path.splitext(path)[0] + SIDECAR_SUFFIX
+    loader = None
+    sizes = {}
+    try:
+        if aggregated_only:
+            used = used_columns(models)
+            for source in sources:
+                source.data = {k: v for k, v in original_data[source.id].items() if k in used}
+        if sidecar:
+            payload = encode_sidecar(sources)
+            for source in sources:
+                source.data = {k: [] for k in source.data}
+            loader = CustomJS(args=dict(sources={s.id: s for s in sources}, url=os.path.basename(sidecar_path)),
+                              code=_LOADER)
+            doc.js_on_event("document_ready", loader)
+        with stage("export.file_html", detail=os.path.basename(path)):
+            html = file_html(root, CDN, title)
+    finally:
+        for source in sources:
+            source.data = original_data[source.id]
+        if loader is not None:
+            doc.callbacks.js_event_callbacks["document_ready"].remove(loader)
+        if temporary_doc:
+            doc.remove_root(root)
+
+    _write_bytes(path, html.encode("utf-8"))
+    sizes[path] = os.path.getsize(path)
+    if sidecar:
+        _write_bytes(sidecar_path, payload)
+        sizes[sidecar_path] = os.path.getsize(sidecar_path)
+    return sizes
+
+
+def export_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Write the dashboard as static HTML")
+    parser.add_argument("-o", "--output", default="dashboard.html", help="HTML file to write")
+    parser.add_argument("-p", "--product", help="app to export (default: DASHBOARD_PRODUCT_ID)")
+    parser.add_argument("--sidecar", action="store_true",
+                        help=f"write the data to a compressed <output>{SIDECAR_SUFFIX} file next to the HTML")
+    parser.add_argument("--aggregated-only", action="store_true",
+                        help="only export the columns that are drawn or shown in tooltips")
+    return parser.parse_args(argv)
+
+
+def report_sizes(sizes):
+    for path, size in sizes.items():
+        print(f"{path}: {size / 1024:.1f} KiB")
+
+
+def main(argv=None):
+    options = export_arguments(argv)
+    dashboard = Dashboard(get_data(product_id=options.product), static=True)
+    show_dashboard(curdoc(), dashboard)
+    sizes = export_dashboard(dashboard.layout, options.output, sidecar=options.sidecar,
+                             aggregated_only=options.aggregated_only)
+    report_sizes(sizes)
+
+
+if __name__ == "__main__":
+    main()
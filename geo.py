@@ -0,0 +1,105 @@
+import pandas as pd
+import numpy as np
+import hashlib
+import os
+
+from atomic import write_atomic
+from instrument import timed
+
+# =====================================================================
+# Country geometry for the world map
+# =====================================================================
+# The Natural Earth shapefile is read, reprojected and simplified once and
+# cached as flat float32 coordinate arrays in an .npz file, so later starts
+# need neither geopandas nor the shapefile. Geometry is kept apart from the
+# attributes: every map metric (sales, ratings, ...) uses the same shapes and
+# only adds its own value column per country.
+#
+# Bokeh's patches cannot draw holes, so only exterior rings are kept; the
+# parts of a multi-polygon are separated by NaN, as Bokeh expects.
+simplify_tolerance = float(os.environ.get("MAP_SIMPLIFY_TOLERANCE", "0.05"))
+ATTRIBUTES = ["ISO_A2", "ADMIN"]
+
+
+class CountryShapes:
+    def __init__(self, attributes, x, y, offsets):
+        self.attributes = attributes
+        self.x = x
+        self.y = y
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.attributes)
+
+    @property
+    def xs(self):
+        # one coordinate array per country (views into the flat arrays)
+        return [self.x[start:end] for start, end in zip(self.offsets[:-1], self.offsets[1:])]
+
+    @property
+    def ys(self):
+        return [self.y[start:end] for start, end in zip(self.offsets[:-1], self.offsets[1:])]
+
+    def column(self, values, key, column, fill=0):
+        # values[column] per country (matched on ISO_A2 == values[key]) in
+        # the order of the shapes; countries without a value get `fill`.
+        by_country = values.set_index(key)[column]
+        return self.attributes["ISO_A2"].map(by_country).fillna(fill).to_numpy()
+
+
+def _exterior_coordinates(geometry):
+    import shapely
+
+    parts = []
+    for polygon in shapely.get_parts(geometry):
+        if polygon.geom_type == "Polygon" and not polygon.is_empty:
+            parts.append(shapely.get_coordinates(polygon.exterior))
+    if not parts:
+        return np.empty((0, 2))
+    separator = np.full((1, 2), np.nan)
+    pieces = []
+    for part in parts:
+        if pieces:
+            pieces.append(separator)
+        pieces.append(part)
+    return np.concatenate(pieces)
+
+
+def build_shapes(shapefile_path, tolerance=simplify_tolerance):
+    import geopandas as gpd
+
+    world = gpd.read_file(shapefile_path).to_crs("EPSG:4326")
+    if tolerance > 0:
+        world["geometry"] = world.geometry.simplify(tolerance, preserve_topology=True)
+    coordinates = [_exterior_coordinates(geometry) for geometry in world.geometry]
+    offsets = np.zeros(len(coordinates) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(c) for c in coordinates])
+    flat = np.concatenate(coordinates) if coordinates else np.empty((0, 2))
+    attributes = pd.DataFrame({col: world[col].astype(str).to_numpy() for col in ATTRIBUTES})
+    return CountryShapes(attributes, flat[:, 0].astype(np.float32), flat[:, 1].astype(np.float32), offsets)
+
+
+def _cache_file(shapefile_path, tolerance, cache_path):
+    stat = os.stat(shapefile_path)
+    key = f"{os.path.abspath(shapefile_path)}|{stat.st_mtime_ns}|{stat.st_size}|{tolerance}|{ATTRIBUTES}"
+    return os.path.join(cache_path, f"world_{hashlib.sha1(key.encode()).hexdigest()[:16]}.npz")
+
+
+@timed("geo.load_shapes")
+def load_shapes(shapefile_path, cache_path, tolerance=simplify_tolerance):
+    # CountryShapes from the .npz cache, building (and caching) it on a miss
+    path = _cache_file(shapefile_path, tolerance, cache_path)
+    try:
+        with np.load(path, allow_pickle=False) as cached:
+            attributes = pd.DataFrame({col: cached[col] for col in ATTRIBUTES})
+            return CountryShapes(attributes, cached["x"], cached["y"], cached["offsets"])
+    except (FileNotFoundError, OSError, KeyError, ValueError):
+        pass
+
+    shapes = build_shapes(shapefile_path, tolerance)
+    os.makedirs(cache_path, exist_ok=True)
+    def write(tmp_path):
+        np.savez(tmp_path, x=shapes.x, y=shapes.y, offsets=shapes.offsets,
+                 **{col: shapes.attributes[col].to_numpy(dtype=str) for col in ATTRIBUTES})
+    write_atomic(path, write, suffix=".npz")
+    return shapes
@@ -0,0 +1,261 @@
+import pandas as pd
+import numpy as np
+import codecs
+import chardet
+
+from currency import as_of_rates
+from instrument import timed
+
+# =====================================================================
+# Encoding detection
+# =====================================================================
+# Detection is a chain of detectors, each taking the first SAMPLE_SIZE bytes
+# of a file and returning an encoding or None to pass it on. The cheap
+# checks go first; chardet (slow, pure Python) is only the last resort.
+# Play Console exports are practically always UTF-16 with a BOM or UTF-8,
+# so chardet is hardly ever reached.
+SAMPLE_SIZE = 100000
+
+_BOMS = [
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+]
+
+
+def _decodes(sample, encoding):
+    # Strict decode check; the sample may end in the middle of a character
+    try:
+        codecs.getincrementaldecoder(encoding)(errors="strict").decode(sample, final=False)
+    except (UnicodeError, LookupError):
+        # UnicodeError: e.g. the utf-16 decoder on a sample without a BOM
+        return False
+    return True
+
+
+def detect_bom(sample):
+    for bom, encoding in _BOMS:
+        if sample.startswith(bom):
+            return encoding
+    return None
+
+
+def detect_utf8(sample):
+    # NUL is valid UTF-8 but never appears in a CSV; it does in every ASCII
+    # character of UTF-16 without a BOM, which is left to chardet
+    if b"\x00" in sample:
+        return None
+    return "utf-8" if _decodes(sample, "utf-8") else None
+
+
+def detect_chardet(sample):
+    return chardet.detect(sample)["encoding"]
+
+
+def _hint_holds(sample, hint):
+    # Whether the sample still passes the check that found the hint: the
+    # BOM for the encodings detected by it, detect_utf8() for UTF-8, and
+    # for chardet's guesses no BOM and a strict decode
+    bom = detect_bom(sample)
+    if hint in ("utf-32", "utf-16", "utf-8-sig"):
+        return bom == hint
+    if hint == "utf-8":
+        return detect_utf8(sample) == hint
+    return bom is None and _decodes(sample, hint)
+
+
+ENCODING_DETECTORS = [detect_bom, detect_utf8, detect_chardet]
+
+
+@timed("ingest.detect_encoding")
+def detect_encoding(file, hint=None, detectors=None):
+    with open(file, "rb") as f:
+        sample = f.read(SAMPLE_SIZE)
+
+    # the encoding remembered in the ingest manifest for a changed file
+    if hint is not None and _hint_holds(sample, hint):
+        return hint
+    for detect in detectors or ENCODING_DETECTORS:
+        encoding = detect(sample)
+        if encoding is not None:
+            return encoding
+    return None
+
+
+# =====================================================================
+# Reading and normalising a single Play Console export
+# =====================================================================
+# read_export() turns one CSV into a normalised frame and tells which kind
+# of export it is ("sales", "crashes" or "ratings"). Everything that needs
+# more than one file (the currency conversion of the aberrant sales formats)
+# is done afterwards by the finish_*() functions, so the output of
+# read_export() can be cached on its own.
+
+
+# Every row carries the app it belongs to in "Product id" (sales exports
+# can contain several apps, crash and ratings exports have a "Package Name").
+# This is the app shown by default, and the one crash and ratings exports
+# without a package name are assumed to belong to.
+PRODUCT_ID = "com.vansteinengroentjes.apps.ddfive"
+# Sales exports are streamed in chunks of this many rows (see read_sales)
+CHUNK_ROWS = 200000
+
+# Only the columns the dashboard uses are parsed. Columns are listed under
+# their normalised names; RENAMES maps the older sales headers (and the
+# package name of crash and ratings exports) onto those. Low-cardinality
+# text columns become categories and amounts float32.
+SALES_RENAMES = {
+    "Product ID": "Product id",
+    "Order Charged Date": "Transaction Date",
+    "Financial Status": "Transaction Type",
+    "Currency of Sale": "Buyer Currency",
+    "SKU ID": "Sku Id",
+}
+PACKAGE_RENAMES = {"Package Name": "Product id"}
+RENAMES = {"sales": SALES_RENAMES, "crashes": PACKAGE_RENAMES, "ratings": PACKAGE_RENAMES}
+SCHEMAS = {
+    "sales": {
+        "columns": ["Transaction Date", "Transaction Type", "Product id", "Sku Id", "Buyer Country",
+                    "Buyer Currency", "Amount (Merchant Currency)", "Currency Conversion Rate", "Charged Amount"],
+        "category": ["Product id", "Sku Id", "Buyer Country", "Buyer Currency"],
+        "float32": ["Amount (Merchant Currency)", "Charged Amount"],
+    },
+    "crashes": {
+        "columns": ["Date", "Product id", "Daily Crashes"],
+        "category": ["Product id"],
+    },
+    "ratings": {
+        "columns": ["Date", "Product id", "Country", "Daily Average Rating", "Total Average Rating"],
+        "category": ["Product id"],
+    },
+}
+
+
+def read_header(file, encoding):
+    return list(pd.read_csv(file, encoding=encoding, nrows=0).columns)
+
+
+def classify_columns(columns):
+    # Identify Sales data
+    if "Transaction Type" in columns or "Financial Status" in columns:
+        return "sales"
+    # Identify Crash data
+    elif "Daily Crashes" in columns and "Daily ANRs" in columns:
+        return "crashes"
+    # Identify Ratings_country data
+    elif "Daily Average Rating" in columns and "Country" in columns:
+        return "ratings"
+    return None
+
+
+def read_chunks(file, encoding, kind, header, chunk_rows=None):
+    # Parse only the columns of SCHEMAS[kind] that this file has, renamed to
+    # their normalised names and with the schema's dtypes. Yields the file in
+    # frames of chunk_rows rows, or as a single frame without chunk_rows.
+    schema = SCHEMAS[kind]
+    renames = RENAMES[kind]
+    usecols = [col for col in header if renames.get(col, col) in schema["columns"]]
+    dtype = {col: "category" for col in usecols if renames.get(col, col) in schema.get("category", [])}
+    if chunk_rows is None:
+        chunks = [pd.read_csv(file, encoding=encoding, usecols=usecols, dtype=dtype)]
+    else:
+        chunks = pd.read_csv(file, encoding=encoding, usecols=usecols, dtype=dtype, chunksize=chunk_rows)
+    for df in chunks:
+        df.rename(columns=renames, inplace=True)
+        for col in schema.get("float32", []):
+            if col in df.columns:
+                df[col] = pd.to_numeric(df[col], errors='coerce').astype("float32")
+        yield df
+
+
+@timed("ingest.read_sales")
+def read_sales(file, encoding, header, product_id=None, chunk_rows=CHUNK_ROWS):
+    # The "Charge" filter (and the product filter, when only one product is
+    # wanted) is applied per chunk: peak memory is bounded by the chunk size
+    # plus the matching rows instead of by the file size.
+    matches = []
+    for chunk in read_chunks(file, encoding, "sales", header, chunk_rows):
+        chunk["Transaction Type"] = chunk["Transaction Type"].replace({
+            "Charged": "Charge"
+        })
+        keep = chunk["Transaction Type"] == "Charge"
+        if product_id is not None:
+            keep &= chunk["Product id"] == product_id
+        matches.append(chunk[keep].drop(columns="Transaction Type"))
+    df = concat_frames(matches)
+    if "Transaction Date" in df.columns:
+        df["Transaction Date"] = pd.to_datetime(df["Transaction Date"], errors='coerce')
+    return df
+
+
+@timed("ingest.read_export")
+def read_export(file, encoding=None, product_id=None):
+    # (kind, frame) of one export, with the rows of all products or only
+    # those of product_id
+    if encoding is None:
+        encoding = detect_encoding(file)
+    header = read_header(file, encoding)
+    kind = classify_columns(header)
+    if kind is None:
+        return None, None
+    if kind == "sales":
+        return kind, read_sales(file, encoding, header, product_id)
+
+    df = next(read_chunks(file, encoding, kind, header))
+    if "Product id" not in df.columns:
+        df["Product id"] = pd.Categorical([PRODUCT_ID] * len(df))
+    if product_id is not None:
+        df = df[df["Product id"] == product_id].reset_index(drop=True)
+    if "Date" in df.columns:
+        df["Date"] = pd.to_datetime(df["Date"], errors='coerce')
+    return kind, df
+
+
+def concat_frames(frames):
+    # pd.concat turns categoricals with different categories (or missing
+    # from some frames) into plain columns, so give every categorical column
+    # the union of all categories first.
+    if not frames:
+        return pd.DataFrame()
+    dtypes = {}
+    for col in dict.fromkeys(col for df in frames for col in df.columns):
+        present = [df[col] for df in frames if col in df.columns]
+        if all(isinstance(values.dtype, pd.CategoricalDtype) for values in present):
+            dtypes[col] = pd.CategoricalDtype(pd.api.types.union_categoricals(present).categories)
+    aligned = []
+    for df in frames:
+        aligned.append(df.assign(**{
+            col: df[col].astype(dtype) if col in df.columns
+            else pd.Categorical.from_codes(np.full(len(df), -1), dtype=dtype)
+            for col, dtype in dtypes.items()
+        }))
+    return pd.concat(aligned, ignore_index=True)
+
+
+@timed("ingest.currency")
+def finish_sales(df, rate_table):
+    # Operations to make the two aberrant sales files be included: their
+    # rates come from rate_table, by currency and day (see currency.py)
+    df = df.copy()
+    if "Currency Conversion Rate" not in df.columns:
+        df["Currency Conversion Rate"] = as_of_rates(df["Buyer Currency"], df["Transaction Date"], rate_table)
+    if "Amount (Merchant Currency)" not in df.columns:
+        df["Charged Amount"] = pd.to_numeric(df["Charged Amount"], errors='coerce')
+        df["Currency Conversion Rate"] = pd.to_numeric(df["Currency Conversion Rate"], errors='coerce')
+        df["Amount (Merchant Currency)"] = (df["Charged Amount"] * df["Currency Conversion Rate"]).astype("float32")
+    df["Month"] = df["Transaction Date"].dt.to_period("M").astype(str)
+    return df
+
+
+def finish_crashes(df):
+    df = df.copy()
+    df["Daily Crashes"] = df.get("Daily Crashes", np.nan).fillna(0)
+    return df
+
+
+def finish_ratings(df):
+    if "Daily Average Rating" in df.columns:
+        return df
+    return df.assign(**{"Daily Average Rating": np.nan})
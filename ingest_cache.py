@@ -0,0 +1,304 @@
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.feather as feather
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import quote
+
+from atomic import write_atomic
+from ingest import read_export, detect_encoding, concat_frames
+from currency import daily_rates
+from instrument import timed
+
+# =====================================================================
+# Persistent columnar cache for normalised exports
+# =====================================================================
+# The output of read_export() (the rows of all products) is stored as
+# uncompressed Feather (Arrow IPC) files partitioned by product and month:
+#   <cache_path>/<product>/<month>/<content hash>.feather
+# so every export is parsed once for all apps, and showing one app only
+# memory-maps that app's partitions. manifest.json maps every source path
+# to its size, mtime, content hash, export kind, encoding and partitions:
+#   - same size and mtime          -> use the cached files straight away
+#   - different, but same content  -> reuse them (e.g. file copied/touched)
+#   - new content                  -> parse the CSV and write new files
+# Sales exports with conversion rates also get their per-day rates (see
+# currency.daily_rates) in <cache_path>/_rates/<content hash>.feather.
+# The partial aggregates of a product in an export (see data_store) are
+# stored once computed, per backend, so a warm start reads no rows at all:
+#   <cache_path>/_partials/<product>/<content hash>-<backend>-v<versions>[-<rates>]/
+# one Feather file per partial plus index.json, written last, with their
+# names and the row count. <versions> includes the pandas version, as the
+# frames are read back into pandas types; <rates> is the version of the
+# rate table a sales export without rates was converted with, and a new
+# one replaces the previous directory.
+# Bump CACHE_VERSION whenever read_export() changes what it produces, and
+# PARTIALS_VERSION whenever the partials (aggregates.py, archive.py) do.
+CACHE_VERSION = 4
+PARTIALS_VERSION = 1
+MANIFEST_NAME = "manifest.json"
+# Partition of the rows without a (valid) date
+NO_MONTH = "unknown"
+# Row number in the source file, to restore the file order of a product's
+# rows across its month partitions
+ROW = "_row"
+DATE_COLUMNS = {"sales": "Transaction Date", "crashes": "Date", "ratings": "Date"}
+RATES_DIR = "_rates"
+PARTIALS_DIR = "_partials"
+
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _arrow_safe(df):
+    # Arrow needs one type per column; CSV columns that pandas left as
+    # object with mixed ints and strings (postal codes, ...) become strings.
+    df = df.copy()
+    for col in df.columns:
+        if df[col].dtype == object:
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+    return df
+
+
+def _partition_path(cache_path, product, month, content_hash):
+    return os.path.join(cache_path, quote(product, safe=""), month, f"{content_hash}.feather")
+
+
+def _rates_path(cache_path, content_hash):
+    return os.path.join(cache_path, RATES_DIR, f"{content_hash}.feather")
+
+
+def _partials_prefix(cache_path, product, content_hash, backend):
+    return os.path.join(cache_path, PARTIALS_DIR, quote(product, safe=""), f"{content_hash}-{backend}-")
+
+
+def _partials_path(cache_path, product, content_hash, backend, rates_key):
+    path = (_partials_prefix(cache_path, product, content_hash, backend)
+            + f"v{CACHE_VERSION}.{PARTIALS_VERSION}-pd{pd.__version__}")
+    return path + f"-{rates_key}" if rates_key else path
+
+
+def partition(kind, df):
+    # {(product, month): rows} of one normalised export; rows without a
+    # product are dropped
+    df = df.reset_index(drop=True)
+    df[ROW] = np.arange(len(df), dtype=np.int32)
+    if DATE_COLUMNS[kind] in df.columns:
+        months = df[DATE_COLUMNS[kind]].dt.strftime("%Y-%m").fillna(NO_MONTH)
+    else:
+        months = pd.Series(NO_MONTH, index=df.index)
+    products = df["Product id"].astype(object)
+    return {(product, month): rows.reset_index(drop=True)
+            for (product, month), rows in df.groupby([products, months], sort=True)}
+
+
+def parse_export(cache_path, path, content_hash, hint=None):
+    # Detect the encoding, parse, classify and normalise one export and write
+    # its partitions (and daily rates) to the cache. Runs in a worker process
+    # in parallel mode, so only (kind, encoding, partitions, has rates)
+    # travels back.
+    encoding = detect_encoding(path, hint=hint)
+    kind, df = read_export(path, encoding)
+    partitions = []
+    rates = daily_rates(df) if kind == "sales" else None
+    if rates is not None:
+        rates_path = _rates_path(cache_path, content_hash)
+        os.makedirs(os.path.dirname(rates_path), exist_ok=True)
+        write_atomic(rates_path, lambda tmp_path: feather.write_feather(rates, tmp_path, compression="uncompressed"))
+    if kind is not None:
+        for (product, month), rows in partition(kind, df).items():
+            frame_path = _partition_path(cache_path, product, month, content_hash)
+            os.makedirs(os.path.dirname(frame_path), exist_ok=True)
+            frame = _arrow_safe(rows)
+            write_atomic(frame_path, lambda tmp_path: feather.write_feather(frame, tmp_path, compression="uncompressed"))
+            partitions.append([product, month])
+    return kind, encoding, partitions, rates is not None
+
+
+def _pool_context():
+    # Not fork: forking while other threads (the server, the callback pool,
+    # the watcher) hold locks can deadlock the workers. The forkserver
+    # imports this module once, so its workers start without re-importing
+    # pandas; where there is none, spawn them.
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload([__name__])
+        return context
+    return multiprocessing.get_context("spawn")
+
+
+class IngestCache:
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.manifest_path = os.path.join(cache_path, MANIFEST_NAME)
+        os.makedirs(self.cache_path, exist_ok=True)
+        self.manifest = self._read_manifest()
+
+    def _read_manifest(self):
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {"version": CACHE_VERSION, "files": {}}
+        if manifest.get("version") != CACHE_VERSION:
+            return {"version": CACHE_VERSION, "files": {}}
+        return manifest
+
+    def save_manifest(self):
+        def write(tmp_path):
+            with open(tmp_path, "w") as f:
+                json.dump(self.manifest, f, indent=1, sort_keys=True)
+        write_atomic(self.manifest_path, write)
+
+    def _paths(self, entry, product=None):
+        return [_partition_path(self.cache_path, p, month, entry["hash"])
+                for p, month in entry["partitions"] if product is None or p == product]
+
+    def _all_paths(self, entry):
+        # Every cache file of an entry: partitions and daily rates
+        rates = [_rates_path(self.cache_path, entry["hash"])] if entry.get("rates") else []
+        return self._paths(entry) + rates
+
+    def product_paths(self, path, product):
+        # The partition files of product in the export at path
+        return self._paths(self.manifest["files"][path], product)
+
+    def _product_partials_path(self, path, product, backend, rates_key):
+        return _partials_path(self.cache_path, product, self.manifest["files"][path]["hash"], backend, rates_key)
+
+    @timed("cache.read_partials")
+    def read_partials(self, path, product, backend, rates_key=None):
+        # The stored (rows, partials) of product in the export at path, or
+        # None when they have not been computed yet or cannot be read (an
+        # unfinished or damaged directory is recomputed, like a miss)
+        partials_path = self._product_partials_path(path, product, backend, rates_key)
+        try:
+            with open(os.path.join(partials_path, "index.json")) as f:
+                index = json.load(f)
+            partials = {name: feather.read_table(os.path.join(partials_path, f"{name}.feather")).to_pandas()
+                        for name in index["names"]}
+            return index["rows"], partials
+        except (OSError, KeyError, TypeError, ValueError, pa.ArrowException):
+            return None
+
+    def write_partials(self, path, product, backend, rates_key, stored):
+        # Store (rows, partials) for read_partials, replacing those made
+        # with another rate table or version
+        rows, partials = stored
+        partials_path = self._product_partials_path(path, product, backend, rates_key)
+        prefix = _partials_prefix(self.cache_path, product, self.manifest["files"][path]["hash"], backend)
+        os.makedirs(partials_path, exist_ok=True)
+        for name, df in partials.items():
+            write_atomic(os.path.join(partials_path, f"{name}.feather"),
+                         lambda tmp_path: feather.write_feather(df, tmp_path, compression="uncompressed"))
+
+        def write(tmp_path):
+            with open(tmp_path, "w") as f:
+                json.dump({"rows": int(rows), "names": list(partials)}, f)
+        write_atomic(os.path.join(partials_path, "index.json"), write)
+        for name in os.listdir(os.path.dirname(prefix)):
+            stale = os.path.join(os.path.dirname(prefix), name)
+            if stale.startswith(prefix) and stale != partials_path:
+                shutil.rmtree(stale, ignore_errors=True)
+
+    @timed("cache.read_product")
+    def read_product(self, path, product):
+        # The rows of product in the export at path (in file order), or None
+        # when the export has none
+        frames = [feather.read_table(frame_path, memory_map=True).to_pandas()
+                  for frame_path in self.product_paths(path, product)]
+        if not frames:
+            return None
+        if len(frames) == 1:
+            return frames[0].drop(columns=ROW)
+        # categories can differ per partition, see ingest.concat_frames
+        df = concat_frames(frames).sort_values(ROW, kind="stable")
+        return df.drop(columns=ROW).reset_index(drop=True)
+
+    def read_rates(self, path):
+        # The daily rates of the export at path, None when it has no rates
+        entry = self.manifest["files"][path]
+        if not entry.get("rates"):
+            return None
+        return feather.read_table(_rates_path(self.cache_path, entry["hash"]), memory_map=True).to_pandas()
+
+    def lookup(self, path, stat):
+        # Return (manifest entry, content hash) for path. The entry is None
+        # when the file has to be parsed again; the hash is only computed
+        # when size or mtime changed.
+        entry = self.manifest["files"].get(path)
+        if entry is not None and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            return entry, entry["hash"]
+
+        content_hash = file_hash(path)
+        for known in self.manifest["files"].values():
+            if known["hash"] == content_hash and all(os.path.exists(p) for p in self._all_paths(known)):
+                entry = dict(known, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+                self.manifest["files"][path] = entry
+                return entry, content_hash
+        return None, content_hash
+
+    @timed("cache.load_many")
+    def load_many(self, paths, workers=1):
+        # Make sure every export is in the cache and return its (kind,
+        # partitions), in the order of paths. Cache misses are parsed by
+        # parse_export(), in a pool of `workers` processes when there is
+        # more than one file to parse.
+        results = {}
+        misses = []
+        for path in paths:
+            stat = os.stat(path)
+            known = self.manifest["files"].get(path)
+            entry, content_hash = self.lookup(path, stat)
+            if entry is not None and all(os.path.exists(p) for p in self._all_paths(entry)):
+                results[path] = entry["kind"], entry["partitions"]
+                continue
+            # A changed export keeps its encoding, so try the remembered one first
+            hint = known.get("encoding") if known else None
+            misses.append((path, stat, content_hash, hint))
+
+        args = ([self.cache_path] * len(misses), [m[0] for m in misses],
+                [m[2] for m in misses], [m[3] for m in misses])
+        if workers > 1 and len(misses) > 1:
+            with ProcessPoolExecutor(max_workers=min(workers, len(misses)), mp_context=_pool_context()) as pool:
+                parsed = list(pool.map(parse_export, *args))
+        else:
+            parsed = list(map(parse_export, *args))
+
+        for (path, stat, content_hash, _), (kind, encoding, partitions, rates) in zip(misses, parsed):
+            self.manifest["files"][path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": content_hash,
+                                            "kind": kind, "encoding": encoding, "partitions": partitions,
+                                            "rates": rates}
+            results[path] = kind, partitions
+        return [results[path] for path in paths]
+
+    def prune(self, paths):
+        # Forget source files that are gone and delete cache files (and
+        # directories) that no manifest entry refers to any more.
+        keep = set(paths)
+        self.manifest["files"] = {p: e for p, e in self.manifest["files"].items() if p in keep}
+        used = {os.path.normpath(p) for e in self.manifest["files"].values() for p in self._all_paths(e)}
+        hashes = {e["hash"] for e in self.manifest["files"].values()}
+        partials_root = os.path.normpath(os.path.join(self.cache_path, PARTIALS_DIR))
+        for root, dirs, files in os.walk(self.cache_path, topdown=False):
+            # the partials of an export are in <partials_root>/<product>/<hash>-...
+            in_partials = os.path.dirname(os.path.dirname(os.path.normpath(root))) == partials_root
+            for name in files:
+                file_path = os.path.normpath(os.path.join(root, name))
+                if in_partials:
+                    if os.path.basename(root).split("-", 1)[0] not in hashes:
+                        os.remove(file_path)
+                elif name.endswith(".feather") and file_path not in used:
+                    os.remove(file_path)
+            if root != self.cache_path and not os.listdir(root):
+                os.rmdir(root)
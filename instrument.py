@@ -0,0 +1,239 @@
+import atexit
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import deque
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+from atomic import write_atomic
+from payload_cache import payload_cache
+
+# =====================================================================
+# Timing and memory instrumentation
+# =====================================================================
+# Pipeline stages (@timed functions and `with stage(...)` blocks) and
+# dashboard callbacks record their wall time, row count and RSS change.
+# Off by default; when off, a timed function only costs one flag check.
+#
+#   DASHBOARD_INSTRUMENT=1    record (kept in memory, last INSTRUMENT_RECORDS)
+#   DASHBOARD_DIAGNOSTICS=1   record and add a "Diagnostics" tab
+#   DIAGNOSTICS_PORT=8765     serve snapshot() as JSON on
+#                             http://DIAGNOSTICS_HOST:8765/ (127.0.0.1)
+#   INSTRUMENT_OUTPUT=x.json  write snapshot() to x.json at exit (CLIs)
+#
+# Every record is also logged as one JSON line on the "instrument" logger
+# at DEBUG level (e.g. `bokeh serve --log-level debug app.py`).
+# Stages that run in ingest worker processes (INGEST_WORKERS > 1) are not
+# recorded; their total shows up in data.sync_files.
+diagnostics = os.environ.get("DASHBOARD_DIAGNOSTICS", "0") == "1"
+enabled = diagnostics or os.environ.get("DASHBOARD_INSTRUMENT", "0") == "1"
+max_records = int(os.environ.get("INSTRUMENT_RECORDS", "1000"))
+diagnostics_host = os.environ.get("DIAGNOSTICS_HOST", "127.0.0.1")
+diagnostics_port = int(os.environ.get("DIAGNOSTICS_PORT", "0"))
+output_path = os.environ.get("INSTRUMENT_OUTPUT")
+
+log = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_records = deque(maxlen=max_records)
+# Per stage name: count, seconds, max_seconds and the last seconds, rows
+# and RSS change
+_stats = {}
+_server = None
+
+
+def _statm_rss():
+    # Current resident set size in bytes, None where /proc is missing
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return None
+
+
+def rss():
+    # Current resident set size in bytes (Linux), else the peak so far
+    current = _statm_rss()
+    return max_rss() if current is None else current
+
+
+def max_rss():
+    # Peak resident set size in bytes; `resource` is Unix only, so on
+    # Windows memory is not measured and this is 0
+    try:
+        import resource
+    except ImportError:
+        return _statm_rss() or 0
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage if sys.platform == "darwin" else usage * 1024
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def _rows(value):
+    # Length of a frame/array result, or of the first frame in a tuple
+    if isinstance(value, (pd.DataFrame, pd.Series, np.ndarray)):
+        return len(value)
+    if isinstance(value, tuple):
+        for item in value:
+            if isinstance(item, pd.DataFrame):
+                return len(item)
+    return None
+
+
+def record(name, seconds, rows=None, rss_delta=None, detail=None, error=None):
+    entry = {
+        "time": round(time.time(), 3),
+        "name": name,
+        "seconds": round(seconds, 6),
+        "rows": rows,
+        "rss_delta_mb": None if rss_delta is None else round(rss_delta / 2**20, 2),
+        "thread": threading.current_thread().name,
+        "detail": None if detail is None else str(detail),
+    }
+    if error is not None:
+        entry["error"] = error
+    with _lock:
+        _records.append(entry)
+        stats = _stats.setdefault(name, {"count": 0, "seconds": 0.0, "max_seconds": 0.0})
+        stats["count"] += 1
+        stats["seconds"] += seconds
+        stats["max_seconds"] = max(stats["max_seconds"], seconds)
+        stats["last_seconds"] = entry["seconds"]
+        stats["last_rows"] = rows
+        stats["last_rss_delta_mb"] = entry["rss_delta_mb"]
+    log.debug(json.dumps(entry))
+
+
+class Stage:
+    # with Stage(name) as s: ...; s.rows = len(df)
+    def __init__(self, name, rows=None, detail=None):
+        self.name = name
+        self.rows = rows
+        self.detail = detail
+
+    def __enter__(self):
+        self.start_rss = rss()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        record(self.name, seconds, self.rows, rss() - self.start_rss, self.detail,
+               None if exc_type is None else exc_type.__name__)
+
+
+class _NoStage:
+    # Stand-in while disabled; attributes set on it are ignored
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return None
+
+    def __setattr__(self, name, value):
+        pass
+
+
+_NO_STAGE = _NoStage()
+
+
+def stage(name, rows=None, detail=None):
+    return Stage(name, rows, detail) if enabled else _NO_STAGE
+
+
+def timed(name):
+    # Decorator recording every call as stage `name`, with the rows of the
+    # frame or array it returns (see _rows)
+    def decorate(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with Stage(name) as current:
+                result = func(*args, **kwargs)
+                current.rows = _rows(result)
+            return result
+        return wrapper
+    return decorate
+
+
+def traced(name, func, detail=None):
+    # func wrapped to record its calls as stage `name` (func itself when
+    # disabled)
+    if not enabled:
+        return func
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with Stage(name, detail=detail):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def snapshot():
+    with _lock:
+        stages = {name: dict(stats) for name, stats in _stats.items()}
+        records = list(_records)
+    return {
+        "enabled": enabled,
+        "pid": os.getpid(),
+        "rss_mb": round(rss() / 2**20, 1),
+        "max_rss_mb": round(max_rss() / 2**20, 1),
+        "payload_cache": payload_cache.stats(),
+        "stages": stages,
+        "records": records,
+    }
+
+
+def reset():
+    with _lock:
+        _records.clear()
+        _stats.clear()
+
+
+class _SnapshotHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = json.dumps(snapshot()).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+
+def start_server(host=diagnostics_host, port=diagnostics_port):
+    # Serve snapshot() as JSON in a thread, once per process (no-op when
+    # disabled or without a port)
+    global _server
+    if not enabled or not port or _server is not None:
+        return _server
+    _server = ThreadingHTTPServer((host, port), _SnapshotHandler)
+    threading.Thread(target=_server.serve_forever, name="diagnostics", daemon=True).start()
+    return _server
+
+
+def write_snapshot(path):
+    data = snapshot()
+
+    def write(tmp_path):
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=1)
+    write_atomic(path, write)
+
+
+if enabled and output_path:
+    atexit.register(write_snapshot, output_path)
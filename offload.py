@@ -0,0 +1,77 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+# =====================================================================
+# Callback work off the event loop
+# =====================================================================
+# Bokeh runs the on_change callbacks of all sessions on one Tornado event
+# loop, so a slow payload for one user would stall every other session.
+# A CallbackRunner (one per session) runs the computing part of a callback
+# in a pool shared by all sessions and applies the result to the models on
+# the session's next tick, with the document locked. A thread pool is used
+# because the work reads the shared in-memory DashboardData (a process
+# would need a copy of it) and pandas/NumPy release the GIL for most of it.
+#
+# Requests are grouped in channels (one per set of models they update).
+# Per channel at most one computation runs; requests made meanwhile are
+# coalesced into the latest one, which starts when the running one is
+# done, and the result of a superseded request is dropped. Clicking
+# through a dropdown therefore costs at most two computations.
+callback_workers = int(os.environ.get("CALLBACK_WORKERS", "4"))
+
+log = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def executor():
+    # The process-wide pool, created on first use
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=callback_workers, thread_name_prefix="callback")
+        return _executor
+
+
+class CallbackRunner:
+    def __init__(self, doc):
+        self.doc = doc
+        self._lock = threading.Lock()
+        self._running = set()
+        self._pending = {}
+
+    def run(self, channel, compute, apply):
+        # Run compute() in the pool and apply(result) on the next tick.
+        # compute must only read shared state, apply updates the models.
+        with self._lock:
+            if channel in self._running:
+                self._pending[channel] = (compute, apply)
+                return
+            self._running.add(channel)
+        self._submit(channel, compute, apply)
+
+    def _submit(self, channel, compute, apply):
+        future = executor().submit(compute)
+        future.add_done_callback(partial(self._done, channel, apply))
+
+    def _done(self, channel, apply, future):
+        with self._lock:
+            pending = self._pending.pop(channel, None)
+            if pending is None:
+                self._running.discard(channel)
+        if pending is not None:
+            # superseded: drop this result and compute the latest request
+            self._submit(channel, *pending)
+            return
+        if future.exception() is not None:
+            log.error("callback computation failed", exc_info=future.exception())
+            return
+        try:
+            self.doc.add_next_tick_callback(partial(apply, future.result()))
+        except Exception:
+            # the session went away meanwhile
+            pass
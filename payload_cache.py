@@ -0,0 +1,123 @@
+import pandas as pd
+import numpy as np
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+# =====================================================================
+# LRU cache for callback payloads
+# =====================================================================
+# The dropdown callbacks turn a selection (month, SKU, country, ...) into
+# the columns for a ColumnDataSource plus the factors of the x-axis. Those
+# payloads only depend on the shared data and the selected value, so they
+# are cached once per server process and shared by all sessions. Keys are
+# (data version, widget, value); the cache is bounded by the estimated size
+# of the payloads and evicts the least recently used ones first.
+#
+# Cached arrays are made read-only because every session sees the same
+# objects; sessions get a fresh dict around them (see columns()).
+max_bytes = int(os.environ.get("PAYLOAD_CACHE_MB", "64")) * 1024 * 1024
+
+
+def _size(value):
+    if isinstance(value, np.ndarray):
+        if value.dtype == object:
+            return value.nbytes + sum(sys.getsizeof(v) for v in value)
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(_size(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(_size(v) for v in value)
+    return sys.getsizeof(value)
+
+
+def _freeze(value):
+    if isinstance(value, np.ndarray):
+        value.flags.writeable = False
+    elif isinstance(value, dict):
+        for v in value.values():
+            _freeze(v)
+    return value
+
+
+def encode_column(values):
+    # Typed NumPy array in the form BokehJS uses, so Bokeh can send it as a
+    # binary buffer as is instead of converting it on every update:
+    # datetimes as float64 milliseconds since the epoch (NaT -> NaN) and
+    # 64-bit integers as int32 when they fit. Text (factors) has to stay
+    # strings; Bokeh sends those as a list whatever we do.
+    values = pd.Series(values)
+    if pd.api.types.is_datetime64_any_dtype(values):
+        ms = values.to_numpy(dtype="datetime64[ms]").astype("int64").astype("float64")
+        ms[values.isna().to_numpy()] = np.nan
+        return ms
+    if isinstance(values.dtype, pd.CategoricalDtype) or pd.api.types.is_string_dtype(values):
+        return values.astype(object).to_numpy()
+    array = values.to_numpy()
+    if array.dtype == np.int64 and (len(array) == 0 or (array.min() >= -2**31 and array.max() < 2**31)):
+        return array.astype(np.int32)
+    return array
+
+
+def frame_columns(df):
+    # DataFrame -> {column: NumPy array}, ready for ColumnDataSource.data
+    return {col: encode_column(df[col]) for col in df.columns}
+
+
+def columns(payload):
+    # Fresh dict (around the shared arrays) to assign to a source's .data
+    return dict(payload["data"])
+
+
+class PayloadCache:
+    def __init__(self, max_bytes=max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, build):
+        # Cached payload for key, or build() it and remember the result
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            self.misses += 1
+
+        payload = _freeze(build())
+        size = _size(payload)
+        with self._lock:
+            if key not in self._entries and size <= self.max_bytes:
+                self._entries[key] = (payload, size)
+                self.bytes += size
+                while self.bytes > self.max_bytes:
+                    _, (_, evicted_size) = self._entries.popitem(last=False)
+                    self.bytes -= evicted_size
+                    self.evictions += 1
+        return payload
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+payload_cache = PayloadCache()
@@ -0,0 +1,105 @@
+import argparse
+import os
+import sys
+
+from atomic import write_atomic
+from data_store import get_data
+
+# =====================================================================
+# Queries and reports
+# =====================================================================
+# Headless entry point for jobs that only need the numbers:
+#
+#   python queries.py                        all reports as CSV on stdout
+#   python queries.py sku_sales -f json      one report as JSON
+#   python queries.py -f parquet -o reports  reports/<name>.parquet
+#   DATA_BACKEND=duckdb python queries.py    the same, aggregated out of
+#                                            core (see archive.py)
+#
+# The data is loaded with get_data(dashboard=False): no Bokeh, geopandas or
+# shapefile, and none of the dashboard-only tables (world map, sales cube).
+
+
+# query that shows the countries with the lowest/highest Total average rating
+# with their respective number of transactions
+def ratings_vs_transactions(data, ascending=True):
+    latest_ratings = data.latest_ratings.copy()
+    result = latest_ratings.merge(data.transactions_per_country, on="Country", how="left")
+    return result.sort_values("Total Average Rating", ascending=ascending)  # False for descending
+
+
+def monthly_turnover(data):
+    return data.sales_by_month
+
+
+def sku_sales(data):
+    return data.sku_sales_df
+
+
+def moving_averages(data):
+    return data.ratings_crashes
+
+
+REPORTS = {
+    "monthly_turnover": monthly_turnover,
+    "sku_sales": sku_sales,
+    "country_ratings": ratings_vs_transactions,
+    "moving_averages": moving_averages,
+}
+FORMATS = ["csv", "json", "parquet"]
+
+
+def write_report(df, file, format):
+    # file is a path or an open text stream (parquet needs a path)
+    if format == "csv":
+        df.to_csv(file, index=False)
+    elif format == "json":
+        df.to_json(file, orient="records", date_format="iso", lines=True)
+    else:
+        df.to_parquet(file, index=False)
+
+
+def write_reports(reports, output_dir, format):
+    # Write every report to <output_dir>/<name>.<format>, each through a
+    # temporary file so a reader never sees a half-written report
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for name, df in reports.items():
+        path = os.path.join(output_dir, f"{name}.{format}")
+        write_atomic(path, lambda tmp_path: write_report(df, tmp_path, format))
+        paths.append(path)
+    return paths
+
+
+def report_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Compute the dashboard metrics without the dashboard")
+    parser.add_argument("reports", nargs="*", metavar="report",
+                        help=f"reports to compute: {', '.join(REPORTS)} (default: all)")
+    parser.add_argument("-f", "--format", choices=FORMATS, default="csv")
+    parser.add_argument("-p", "--product", help="app to report on (default: DASHBOARD_PRODUCT_ID)")
+    parser.add_argument("-o", "--output-dir", help="write <report>.<format> files here instead of to stdout")
+    options = parser.parse_args(argv)
+    unknown = [name for name in options.reports if name not in REPORTS]
+    if unknown:
+        parser.error(f"unknown report: {', '.join(unknown)}")
+    if options.format == "parquet" and options.output_dir is None:
+        parser.error("parquet output needs --output-dir")
+    return options
+
+
+def main(argv=None):
+    options = report_arguments(argv)
+    data = get_data(product_id=options.product, dashboard=False)
+    reports = {name: REPORTS[name](data) for name in options.reports or REPORTS}
+    if options.output_dir is not None:
+        for path in write_reports(reports, options.output_dir, options.format):
+            print(path)
+        return
+    for name, df in reports.items():
+        if len(reports) > 1:
+            print(f"# {name}")
+        write_report(df, sys.stdout, options.format)
+
+
+if __name__ == "__main__":
+    main()
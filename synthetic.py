@@ -0,0 +1,224 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from ingest import PRODUCT_ID
+
+# =====================================================================
+# Synthetic Play Console exports
+# =====================================================================
+# Writes a data/ directory that looks like a real Play Console download,
+# for benchmarks (see benchmark.py) and for trying the dashboard without
+# the (confidential) real exports:
+#
+#   python synthetic.py bench/1m -n 1000000
+#
+# One sales export per month, rotating through the header variants the
+# loader handles (see ingest.SALES_RENAMES and finish_sales):
+#   - "new":     Transaction Date, Transaction Type, Sku Id, ...
+#   - "old":     Order Charged Date, Financial Status ("Charged"), SKU ID,
+#                Currency of Sale, only Charged Amount, no conversion rate
+#   - "no_rate": the new headers without Currency Conversion Rate
+# plus per month a crashes overview and a per-country ratings export,
+# in a mix of UTF-16 (what the Play Console writes), UTF-8 and UTF-8 with
+# BOM. Sales exports are written in chunks, so even 50M transactions need
+# little memory. Output only depends on the arguments and the seed.
+PRODUCTS = [PRODUCT_ID, "com.example.companion"]
+# Buyer country -> (currency, EUR per unit of it)
+COUNTRIES = {
+    "US": ("USD", 0.89), "NL": ("EUR", 1.0), "DE": ("EUR", 1.0), "FR": ("EUR", 1.0), "BE": ("EUR", 1.0),
+    "ES": ("EUR", 1.0), "IT": ("EUR", 1.0), "GB": ("GBP", 1.17), "CA": ("CAD", 0.7), "AU": ("AUD", 0.63),
+    "BR": ("BRL", 0.17), "IN": ("INR", 0.011), "JP": ("JPY", 0.0075), "PL": ("PLN", 0.22), "SE": ("SEK", 0.09),
+    "MX": ("MXN", 0.045), "KR": ("KRW", 0.00072), "ZA": ("ZAR", 0.058), "TR": ("TRY", 0.1), "CH": ("CHF", 0.95),
+}
+# Share of the buyers per country (the US dominates, as in the real data)
+COUNTRY_WEIGHTS = np.array([40, 6, 8, 5, 2, 4, 3, 7, 4, 3, 3, 3, 2, 2, 1, 2, 1, 1, 1, 1], dtype=float)
+SKUS = ["premium", "unlockcharactermanager", "dicepack", "spellbook", "monsterpack", "removeads"]
+PRICES = np.array([4.99, 2.99, 0.99, 1.99, 1.49, 0.99])
+PRODUCT_TITLE = "Dungeons & Dragons 5e – Würfel & Zauber"
+SALES_VARIANTS = ["new", "old", "no_rate"]
+ENCODINGS = ["utf-16", "utf-8", "utf-8-sig"]
+CHUNK_ROWS = 500000
+
+
+def _months(start, months):
+    return list(pd.period_range(start, periods=months, freq="M"))
+
+
+def _pick(rng, values, n, p=None):
+    return np.asarray(values, dtype=object)[rng.choice(len(values), n, p=p)]
+
+
+def _order_numbers(first, n):
+    return np.char.mod("GPA.%016d", np.arange(first, first + n)).astype(object)
+
+
+def sales_chunk(rng, variant, month, n, first_order):
+    # n transactions of one month in the columns of a sales export variant
+    days = month.days_in_month
+    day = rng.integers(0, days, n)
+    country = rng.choice(len(COUNTRIES), n, p=COUNTRY_WEIGHTS / COUNTRY_WEIGHTS.sum())
+    codes = np.array(list(COUNTRIES), dtype=object)[country]
+    currencies = np.array([c for c, _ in COUNTRIES.values()], dtype=object)[country]
+    rates = np.array([r for _, r in COUNTRIES.values()])[country]
+    sku = rng.choice(len(SKUS), n)
+    # prices in the buyer's currency, rounded like a store price
+    buyer_amount = np.round(PRICES[sku] / rates, 2)
+    product = _pick(rng, PRODUCTS, n, p=[0.8, 0.2])
+    dates = pd.date_range(month.start_time, periods=days, freq="D")
+
+    if variant == "old":
+        return pd.DataFrame({
+            "Order Number": _order_numbers(first_order, n),
+            "Order Charged Date": np.array(dates.strftime("%Y-%m-%d"), dtype=object)[day],
+            "Order Charged Timestamp": (dates.asi8 // 10**9)[day] + rng.integers(0, 86400, n),
+            "Financial Status": _pick(rng, ["Charged", "Refund"], n, p=[0.95, 0.05]),
+            "Device Model": _pick(rng, ["a52q", "beyond1", "redfin", "OnePlus7T"], n),
+            "Product Title": PRODUCT_TITLE,
+            "Product ID": product,
+            "Product Type": "inapp",
+            "SKU ID": np.array(SKUS, dtype=object)[sku],
+            "Currency of Sale": currencies,
+            "Item Price": buyer_amount,
+            "Taxes Collected": np.round(buyer_amount * 0.2, 2),
+            "Charged Amount": buyer_amount,
+            "City of Buyer": "",
+            "State of Buyer": "",
+            "Postal Code of Buyer": "",
+            "Country of Buyer": codes,
+        })
+
+    # Every charge comes with a Google fee row; a few are refunds or taxes
+    kind = _pick(rng, ["Charge", "Google fee", "Tax", "Charge refund"], n, p=[0.6, 0.3, 0.07, 0.03])
+    sign = np.where((kind == "Google fee") | (kind == "Charge refund"), -1.0, 1.0)
+    share = np.where(kind == "Google fee", 0.15, np.where(kind == "Tax", 0.2, 1.0))
+    buyer_amount = np.round(buyer_amount * share * sign, 2)
+    conversion = rates * (1 + rng.normal(0, 0.002, n))
+    frame = {
+        "Description": _order_numbers(first_order, n),
+        "Transaction Date": np.array([f"{d:%b} {d.day}, {d.year}" for d in dates], dtype=object)[day],
+        "Transaction Time": "12:00:00 PM PDT",
+        "Tax Type": "",
+        "Transaction Type": kind,
+        "Refund Type": "",
+        "Product Title": PRODUCT_TITLE,
+        "Product id": product,
+        "Product Type": 1,
+        "Sku Id": np.array(SKUS, dtype=object)[sku],
+        "Hardware": _pick(rng, ["a52q", "beyond1", "redfin", "OnePlus7T"], n),
+        "Buyer Country": codes,
+        "Buyer State": "",
+        "Buyer Postal Code": "",
+        "Buyer Currency": currencies,
+        "Amount (Buyer Currency)": buyer_amount,
+        "Currency Conversion Rate": np.round(conversion, 6),
+        "Merchant Currency": "EUR",
+        "Amount (Merchant Currency)": np.round(buyer_amount * conversion, 2),
+    }
+    if variant == "no_rate":
+        del frame["Currency Conversion Rate"]
+    return pd.DataFrame(frame)
+
+
+def write_csv(path, frames, encoding):
+    # One CSV from a sequence of frames; the stream writes a single BOM
+    with open(path, "w", encoding=encoding, newline="") as f:
+        for i, df in enumerate(frames):
+            df.to_csv(f, index=False, header=i == 0)
+
+
+def crashes_frame(rng, month):
+    dates = pd.date_range(month.start_time, periods=month.days_in_month, freq="D").strftime("%Y-%m-%d")
+    rows = len(dates) * len(PRODUCTS)
+    return pd.DataFrame({
+        "Date": np.tile(dates, len(PRODUCTS)),
+        "Package Name": np.repeat(PRODUCTS, len(dates)),
+        "Daily Crashes": rng.poisson(12, rows),
+        "Daily ANRs": rng.poisson(3, rows),
+    })
+
+
+def ratings_frame(rng, month):
+    dates = pd.date_range(month.start_time, periods=month.days_in_month, freq="D").strftime("%Y-%m-%d")
+    countries = list(COUNTRIES)
+    rows = len(dates) * len(countries) * len(PRODUCTS)
+    daily = np.round(rng.uniform(1, 5, rows), 2)
+    # most countries do not get a rating every day
+    daily[rng.random(rows) < 0.6] = np.nan
+    return pd.DataFrame({
+        "Date": np.tile(np.repeat(dates, len(countries)), len(PRODUCTS)),
+        "Package Name": np.repeat(PRODUCTS, len(dates) * len(countries)),
+        "Country": np.tile(countries, len(dates) * len(PRODUCTS)),
+        "Daily Average Rating": daily,
+        "Total Average Rating": np.round(rng.uniform(3.5, 4.8, rows), 2),
+    })
+
+
+def write_shapes(shapefile_path):
+    # A stand-in for the Natural Earth shapefile: one square per country
+    import geopandas as gpd
+    from shapely.geometry import box
+    codes = list(COUNTRIES)
+    shapes = gpd.GeoDataFrame({"ADMIN": [f"Country {code}" for code in codes], "ISO_A2": codes},
+                              geometry=[box(-180 + i * 17, -10, -170 + i * 17, 10) for i in range(len(codes))],
+                              crs="EPSG:4326")
+    os.makedirs(os.path.dirname(shapefile_path), exist_ok=True)
+    shapes.to_file(shapefile_path)
+
+
+def generate(root, transactions=100000, months=12, start="2021-01", seed=0, shapes=True):
+    # Write <root>/data (and <root>/worldmap) and return the CSV paths
+    rng = np.random.default_rng(seed)
+    data_path = os.path.join(root, "data")
+    os.makedirs(data_path, exist_ok=True)
+    periods = _months(start, months)
+    per_month = np.full(months, transactions // months)
+    per_month[:transactions % months] += 1
+    paths = []
+    order = 0
+    for i, (month, n) in enumerate(zip(periods, per_month)):
+        ym = month.strftime("%Y%m")
+        variant = SALES_VARIANTS[i % len(SALES_VARIANTS)]
+        chunks = []
+        for first in range(0, n, CHUNK_ROWS):
+            chunks.append((order + first, min(CHUNK_ROWS, n - first)))
+        frames = (sales_chunk(rng, variant, month, rows, first) for first, rows in chunks)
+        path = os.path.join(data_path, f"salesreport_{ym}.csv" if variant != "old" else f"sales_{ym}.csv")
+        write_csv(path, frames, ENCODINGS[i % len(ENCODINGS)])
+        order += n
+        paths.append(path)
+
+        path = os.path.join(data_path, f"stats_crashes_{ym}_overview.csv")
+        write_csv(path, [crashes_frame(rng, month)], ENCODINGS[(i + 1) % len(ENCODINGS)])
+        paths.append(path)
+        path = os.path.join(data_path, f"stats_ratings_{ym}_country.csv")
+        write_csv(path, [ratings_frame(rng, month)], "utf-16")
+        paths.append(path)
+    if shapes:
+        write_shapes(os.path.join(root, "worldmap", "ne_110m_admin_0_countries.shp"))
+    return paths
+
+
+def generate_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Write synthetic Play Console exports")
+    parser.add_argument("root", help="writes <root>/data and <root>/worldmap")
+    parser.add_argument("-n", "--transactions", type=int, default=100000,
+                        help="number of sales rows over all months (default: 100000)")
+    parser.add_argument("--months", type=int, default=12)
+    parser.add_argument("--start", default="2021-01", help="first month, YYYY-MM (default: 2021-01)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-shapes", action="store_true", help="do not write the stand-in shapefile")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = generate_arguments(argv)
+    for path in generate(options.root, options.transactions, options.months, options.start,
+                         options.seed, not options.no_shapes):
+        print(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import pandas as pd
+import numpy as np
+
+from instrument import timed
+
+# =====================================================================
+# Date-range queries over the sales
+# =====================================================================
+# The sales cube (amount and count per day, SKU and country, see
+# aggregates.merge_cube) is the date-sorted store of all transactions,
+# already reduced to one row per day and key. SalesIndex turns it into
+# prefix sums over the sorted days: per day, per (day, SKU) and per
+# (day, country). The totals of any date range are then two binary
+# searches and the difference of two prefix rows, so a query costs the
+# same at 10k or 50M transactions; only the per-day series of a range
+# (for p1) is a slice.
+#
+# Rows without a SKU or country (older export formats) count for the
+# per-day totals only, as in the all-time tables.
+
+
+def _codes(values):
+    codes, labels = pd.factorize(pd.Series(values).astype(object), sort=True)
+    return codes, [str(label) for label in labels]
+
+
+class SalesIndex:
+    @timed("time_index.build")
+    def __init__(self, cube):
+        day_values = pd.to_datetime(cube["Day"]).to_numpy(dtype="datetime64[D]")
+        day_codes, days = pd.factorize(day_values, sort=True)
+        self.days = np.asarray(days, dtype="datetime64[D]")
+        amount = cube["amount"].to_numpy(dtype=float)
+        count = cube["count"].to_numpy(dtype=float)
+
+        self.day_amount = self._prefix(day_codes, np.zeros(len(day_codes), dtype=np.int64), 1, amount)[:, 0]
+        self.day_count = self._prefix(day_codes, np.zeros(len(day_codes), dtype=np.int64), 1, count)[:, 0]
+        sku_codes, self.skus = _codes(cube["Sku Id"])
+        self.sku_amount = self._prefix(day_codes, sku_codes, len(self.skus), amount)
+        self.sku_count = self._prefix(day_codes, sku_codes, len(self.skus), count)
+        country_codes, self.countries = _codes(cube["Buyer Country"])
+        self.country_amount = self._prefix(day_codes, country_codes, len(self.countries), amount)
+        self.country_count = self._prefix(day_codes, country_codes, len(self.countries), count)
+
+    def _prefix(self, day_codes, codes, width, values):
+        # (days + 1) x width running totals; row i sums the days before i
+        keep = codes >= 0
+        flat = (day_codes[keep] + 1) * width + codes[keep]
+        totals = np.bincount(flat, weights=values[keep], minlength=(len(self.days) + 1) * width)
+        return totals.reshape(len(self.days) + 1, width).cumsum(axis=0)
+
+    def __len__(self):
+        return len(self.days)
+
+    @property
+    def first(self):
+        return pd.Timestamp(self.days[0]) if len(self.days) else None
+
+    @property
+    def last(self):
+        return pd.Timestamp(self.days[-1]) if len(self.days) else None
+
+    def bounds(self, start, end):
+        # Positions of the days in [start, end] (both inclusive, any
+        # datetime-like, None: open)
+        lo = 0 if start is None else int(np.searchsorted(self.days, np.datetime64(pd.Timestamp(start), "D"), "left"))
+        hi = len(self.days) if end is None else int(np.searchsorted(self.days, np.datetime64(pd.Timestamp(end), "D"),
+                                                                    "right"))
+        return lo, max(hi, lo)
+
+    def _totals(self, labels, amount, count, start, end):
+        lo, hi = self.bounds(start, end)
+        counts = count[hi] - count[lo]
+        nonzero = counts > 0
+        return pd.DataFrame({
+            "label": np.asarray(labels, dtype=object)[nonzero],
+            "Amount (Merchant Currency)": (amount[hi] - amount[lo])[nonzero],
+            "Transaction Count": counts[nonzero].astype(np.int64),
+        })
+
+    def sku_totals(self, start=None, end=None):
+        # Amount and count per SKU between start and end
+        return self._totals(self.skus, self.sku_amount, self.sku_count, start, end).rename(columns={"label": "Sku Id"})
+
+    def country_totals(self, start=None, end=None):
+        return self._totals(self.countries, self.country_amount, self.country_count, start, end) \
+            .rename(columns={"label": "Country"})
+
+    def daily(self, start=None, end=None):
+        # Amount and count of every day with sales between start and end
+        lo, hi = self.bounds(start, end)
+        return pd.DataFrame({
+            "Day": self.days[lo:hi],
+            "Amount (Merchant Currency)": np.diff(self.day_amount[lo:hi + 1]),
+            "Transaction Count": np.diff(self.day_count[lo:hi + 1]).astype(np.int64),
+        })
+
+    def monthly(self, start=None, end=None):
+        # Amount and count per calendar month (clipped to start and end)
+        lo, hi = self.bounds(start, end)
+        months = self.days[lo:hi].astype("datetime64[M]")
+        if not len(months):
+            return pd.DataFrame({"Month": [], "Amount (Merchant Currency)": [], "Transaction Count": []})
+        first = np.flatnonzero(np.r_[True, months[1:] != months[:-1]])
+        edges = lo + np.r_[first, hi - lo]
+        return pd.DataFrame({
+            "Month": months[first].astype(str),
+            "Amount (Merchant Currency)": np.diff(self.day_amount[edges]),
+            "Transaction Count": np.diff(self.day_count[edges]).astype(np.int64),
+        })
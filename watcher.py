@@ -0,0 +1,104 @@
+import logging
+import os
+import threading
+from functools import partial
+
+import data_store
+
+# =====================================================================
+# Live reload of the data directory
+# =====================================================================
+# Under `bokeh serve` a DataWatcher thread polls data_store.data_path for
+# CSVs that were added, changed or removed. A change reloads, in the
+# watcher thread and so off the Bokeh event loop, every product that is
+# loaded in this process; get_data() only parses the changed files and
+# merges their partial aggregates (see data_store), so a reload costs about
+# as much as the files that changed. The new DashboardData is then pushed
+# to the sessions showing that product with add_next_tick_callback, which
+# runs the session's callback on the event loop with the document locked.
+# Polling (os.stat per CSV) needs no extra dependency and also works on
+# network and container mounts where file system events are unreliable.
+# DATA_WATCH_INTERVAL (seconds, default 5) sets the polling interval,
+# 0 turns the watcher off.
+watch_interval = float(os.environ.get("DATA_WATCH_INTERVAL", "5"))
+
+log = logging.getLogger(__name__)
+
+
+class DataWatcher:
+    def __init__(self, data_path=data_store.data_path, interval=watch_interval):
+        self.data_path = data_path
+        self.interval = interval
+        # {document: (product, callback)} of the open sessions
+        self.sessions = {}
+        self._sessions_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._signature = None
+        self._thread = None
+
+    def _data_signature(self):
+        return data_store._file_signature(data_store._csv_files(self.data_path))
+
+    def start(self):
+        if self._thread is None:
+            self._signature = self._data_signature()
+            self._thread = threading.Thread(target=self._run, name="data-watcher", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def subscribe(self, doc, product_id, callback):
+        # Call callback(data) on doc's next tick whenever the data of
+        # product_id was reloaded (replaces doc's previous subscription)
+        with self._sessions_lock:
+            self.sessions[doc] = (product_id, callback)
+
+    def unsubscribe(self, doc):
+        with self._sessions_lock:
+            self.sessions.pop(doc, None)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                signature = self._data_signature()
+                if signature != self._signature:
+                    self._signature = signature
+                    self.reload()
+            except Exception:
+                # keep watching; the next change gets another try
+                log.exception("reloading %s failed", self.data_path)
+
+    def reload(self):
+        # Reload every loaded product and notify the sessions of the products
+        # whose data changed
+        for product in data_store.loaded_products():
+            old = data_store.get_data(product_id=product, reload=False)
+            data = data_store.get_data(product_id=product)
+            if data is not old:
+                self.notify(product, data)
+
+    def notify(self, product_id, data):
+        with self._sessions_lock:
+            sessions = [(doc, callback) for doc, (product, callback) in self.sessions.items()
+                        if product == product_id]
+        for doc, callback in sessions:
+            try:
+                doc.add_next_tick_callback(partial(callback, data))
+            except Exception:
+                # the session went away meanwhile
+                self.unsubscribe(doc)
+
+
+_watcher = None
+
+
+def start_watcher():
+    # The process-wide watcher, started on first use; None when turned off
+    global _watcher
+    if watch_interval <= 0:
+        return None
+    if _watcher is None:
+        _watcher = DataWatcher()
+        _watcher.start()
+    return _watcher